@@ -18,37 +18,43 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import hashlib
+import httplib
 import os
 import re
+import shutil
+import socket
+import tarfile
 import tempfile
+import threading
 import time
 import urllib2
-import cgi
 import xml.etree.cElementTree as ElementTree
 from urllib2 import HTTPError
-from osc import conf, core
+from osc import core
 from urllib import quote, quote_plus
-
-prj_template = """\
-<project name="%(name)s">
-
-  <title>%(title)s</title>
-  <description>%(description)s</description>
-
-  %(maintainers)s
-  %(link)s
-  %(flags)s
-%(repositories)s
-
-</project>
-"""
-
-repo_template = """  <repository name="%(repository)s" %(mechanism)s block="%(block)s" rebuild="%(rebuild)s">
-%(paths)s
-%(archs)s
-  </repository>\n"""
-
-path_template = '<path project="%(project)s" repository="%(repository)s"/>'
+from contextlib import contextmanager
+from history import HistoryStore
+from cache import ObjectCache, MemoryCache
+from index import ProjectCatalog, PersonIndex, RepositoryGraph
+from reqindex import RequestIndex
+from sampler import WorkerSampler
+import tracing
+import transport
+from transport import parallel_map
+
+md5_re = re.compile('^[0-9a-f]{32}$')
+
+# Default (category, regex) pairs for scanBuildLogs, the first match wins
+# Build log lines start with the build time, like '[  123s] '
+LOG_PATTERNS = [
+    ('unresolvable', r'^(?:\[\s*\d+s\]\s*)?(nothing provides|have choice for|conflict for provider)'),
+    ('missing-files', r'(Installed \(but unpackaged\) file\(s\) found|File not found: /)'),
+    ('compile', r'(: error: |: fatal error: |undefined reference to )'),
+    ('test', r'(FAIL: |make(\[\d+\])?: \*\*\* \[(check|test)\])'),
+    ('rpmbuild', r'^(?:\[\s*\d+s\]\s*)?error: Bad exit status from '),
+    ('worker', r'(Killed|No space left on device|Job seems to be stuck here, killed)'),
+]
 
 
 def flag2bool(flag):
@@ -73,46 +79,80 @@ def bool2flag(b):
     elif b == False:
         return 'disable'
 
+def chunked(values, param, limit=4000):
+    """
+    chunked(values, param, limit=4000) -> generator of lists
+
+    Split values into lists that fit in an URL as repeated 'param=value'
+    query parameters of at most limit characters
+    """
+    chunk = []
+    size = 0
+    for value in values:
+        length = len(param) + len(quote_plus(value)) + 2
+        if chunk and size + length > limit:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(value)
+        size += length
+    if chunk:
+        yield chunk
 
 class metafile:
     """
     metafile(url, input, change_is_required=False, file_ext='.xml')
 
-    Implementation on osc.core.metafile that does not print to stdout
+    Implementation on osc.core.metafile that does not print to stdout and
+    keeps the meta in memory
     """
     def __init__(self, url, input, change_is_required=False, file_ext='.xml'):
         self.url = url
         self.change_is_required = change_is_required
-
-        (fd, self.filename) = tempfile.mkstemp(prefix = 'osc_metafile.', suffix = file_ext, dir = '/tmp')
-
-        f = os.fdopen(fd, 'w')
-        f.write(''.join(input))
-        f.close()
-
-        self.hash_orig = core.dgst(self.filename)
+        self.data = ''.join(input)
+        self.hash_orig = hashlib.md5(self.data).hexdigest()
 
     def sync(self):
-        hash = core.dgst(self.filename)
+        hash = hashlib.md5(self.data).hexdigest()
         if self.change_is_required == True and hash == self.hash_orig:
-            os.unlink(self.filename)
             return True
 
         # don't do any exception handling... it's up to the caller what to do in case
         # of an exception
-        core.http_PUT(self.url, file=self.filename)
-        os.unlink(self.filename)
+        core.http_PUT(self.url, data=self.data)
         return True
 
+@tracing.traced
+@transport.bound
 class BuildService():
-    "Interface to Build Service API"
-    def __init__(self, apiurl=None, oscrc=None):
+    """
+    BuildService(apiurl=None, oscrc=None, cache_dir=None, cache_size=1024*1024*1024,
+                 diff_cache_size=16*1024*1024)
+
+    Interface to Build Service API
+
+    All HTTP requests to an API server pass a shared
+    transport.AdmissionController, see transport.configure() to tune it.
+    Concurrent identical calls of read only methods like getProjectResults
+    share one request, transport.flights.stats() tells how many were saved.
+
+    If cache_dir is given, immutable objects (sources at a srcmd5, expanded
+    file lists at the srcmd5 of the expansion and binaries with a known
+    checksum) are kept in an ObjectCache there, holding at most cache_size
+    bytes.
+
+    Server side diffs are kept in memory, up to diff_cache_size bytes, and in
+    the ObjectCache if there is one.
+
+    Every instance keeps its own configuration and credentials in a
+    transport.Session, so instances using different oscrc files can be
+    used side by side, and from several threads.
+    """
+    def __init__(self, apiurl=None, oscrc=None, cache_dir=None, cache_size=1024*1024*1024,
+                 diff_cache_size=16*1024*1024):
 
         try:
-            if oscrc:
-                conf.get_config(override_conffile = oscrc)
-            else:
-                conf.get_config()
+            self.session = transport.Session(oscrc)
 
         except OSError, e:
             if e.errno == 1:
@@ -121,17 +161,27 @@ class BuildService():
 
             raise # else
 
+        config = self.session.config
         if apiurl:
-            self.apiurl = conf.config['apiurl_aliases'].get(apiurl, apiurl)
+            self.apiurl = config['apiurl_aliases'].get(apiurl, apiurl)
         else:
-            self.apiurl = conf.config['apiurl']
+            self.apiurl = config['apiurl']
 
         if not self.apiurl:
             raise RuntimeError, 'No apiurl "%s" found in %s' % (apiurl, oscrc)
 
+        transport.install()
+        self.history = HistoryStore(self.apiurl, session=self.session)
+        self.projects = ProjectCatalog(self.apiurl, session=self.session)
+        self._local = threading.local()
+        self.cache = None
+        if cache_dir:
+            self.cache = ObjectCache(cache_dir, max_size=cache_size)
+        self.diffs = MemoryCache(diff_cache_size, self.cache)
+
         # Add a couple of method aliases
-        self.copyPackage = core.copy_pac
-        self.addPerson   = core.addPerson
+        self.copyPackage = transport.in_session(self.session, core.copy_pac)
+        self.addPerson   = transport.in_session(self.session, core.addPerson)
 
     def getAPIServerList(self):
         """getAPIServerList() -> list
@@ -139,8 +189,13 @@ class BuildService():
         Get list of API servers configured in .oscrc
         """
         apiservers = []
-        for host in conf.config['api_host_options'].keys():
-            apiurl = "%s://%s" % (conf.config['scheme'], host)
+        config = self.session.config
+        for host in config['api_host_options'].keys():
+            if '://' in host:
+                apiurl = host
+            else:
+                apiurl = "%s://%s" % (config['scheme'], host)
+            apiservers.append(apiurl)
         return apiservers
 
     # the following two alias api are added temporarily for compatible safe
@@ -289,11 +344,21 @@ class BuildService():
             else:
                 query = None
 
-            u = core.makeurl(apiurl, ['source', prj, pac, core.pathname2url(path)], query=query)
+            # the expanded srcmd5 pins the content
+            key = 'srcfile/%s/%s' % (revision, path)
+            content = None
+            if self.cache and revision:
+                content = self.cache.get(key)
+
+            if content is None:
+                u = core.makeurl(apiurl, ['source', prj, pac, core.pathname2url(path)], query=query)
 
-            content = ''
-            for buf in core.streamfile(u, core.http_GET, core.BUFSIZE):
-                content += buf
+                content = ''
+                for buf in core.streamfile(u, core.http_GET, core.BUFSIZE):
+                    content += buf
+
+                if self.cache and revision:
+                    self.cache.put(key, content)
 
             # return unicode str
             return content.decode('utf8')
@@ -327,7 +392,7 @@ class BuildService():
                 raise e
 
         if new_pkg:
-            src_fl = core.meta_get_filelist(self.apiurl, src_project, src_package, expand=True, revision=src_rev)
+            src_fl = self.getPackageFileList(src_project, src_package, revision=src_rev)
 
             spec_file = None
             yaml_file = None
@@ -359,9 +424,8 @@ class BuildService():
 
         else:
             try:
-                diff = core.server_diff(self.apiurl,
-                                    tgt_project, tgt_package, None,
-                                    src_project, src_package, src_rev, False)
+                diff = self.serverDiff(tgt_project, tgt_package, None,
+                                       src_project, src_package, src_rev, False)
 
                 try:
                     reqinfo += diff.decode('utf-8')
@@ -389,7 +453,7 @@ class BuildService():
 
         Get the user name associated with the current API server
         """
-        return conf.config['api_host_options'][self.apiurl]['user']
+        return self.session.host_options(self.apiurl)['user']
 
     def getProjectList(self):
         """getProjectList() -> list
@@ -411,49 +475,84 @@ class BuildService():
             for project in watchlist.findall('project'):
                 projects.append(project.get('name'))
         homeproject = 'home:%s' % username
-        if not homeproject in projects and homeproject in self.getProjectList():
+        if not homeproject in projects and self._projectExists(homeproject):
             projects.append(homeproject)
         return projects
 
-    def watchProject(self, project):
+    @contextmanager
+    def editMeta(self, metatype, *path_args):
         """
-        watchProject(project)
+        editMeta(metatype, *path_args)
 
-        Watch project
+        Context manager for changing a meta document ('prj', 'pkg', 'user',
+        'group', ...) in memory:
+
+            with bs.editMeta('user', name) as person:
+                ...
+
+        The document is only sent back if the serialized tree changed, and
+        only once when edits of the same document are nested. If the server
+        gave an ETag, the write is conditional and fails with HTTP 412 when
+        somebody else changed the document meanwhile.
         """
-        username = self.getUserName()
-        data = core.meta_exists('user', username, create_new=False, apiurl=self.apiurl)
-        url = core.make_meta_url('user', username, self.apiurl)
+        url = core.make_meta_url(metatype, tuple(quote_plus(str(a)) for a in path_args),
+                                 self.apiurl)
+        edits = self._local.__dict__.setdefault('meta_edits', {})
+        if url in edits:
+            yield edits[url]
+            return
 
-        person = ElementTree.fromstring(''.join(data))
-        watchlist = person.find('watchlist')
-        if not watchlist:
-            watchlist = ElementTree.SubElement(person, 'watchlist')
-        ElementTree.SubElement(watchlist, 'project', name=str(project))
+        f = transport.http_request('GET', url)
+        etag = f.info().getheader('ETag')
+        tree = ElementTree.parse(f).getroot()
+        hash_orig = hashlib.md5(ElementTree.tostring(tree)).digest()
 
-        f = metafile(url, ElementTree.tostring(person))
-        f.sync()
+        edits[url] = tree
+        try:
+            yield tree
+        finally:
+            del edits[url]
+
+        data = ElementTree.tostring(tree)
+        if hashlib.md5(data).digest() == hash_orig:
+            return
+        headers = {}
+        if etag:
+            headers['If-Match'] = etag
+        transport.http_request('PUT', url, headers=headers, data=data)
 
-    def unwatchProject(self, project):
+    def watchProject(self, project):
         """
         watchProject(project)
 
         Watch project
         """
-        username = self.getUserName()
-        data = core.meta_exists('user', username, create_new=False, apiurl=self.apiurl)
-        url = core.make_meta_url('user', username, self.apiurl)
-
-        person = ElementTree.fromstring(''.join(data))
-        watchlist = person.find('watchlist')
-        for node in watchlist:
-            if node.get('name') == str(project):
-                watchlist.remove(node)
-                break
+        with self.editMeta('user', self.getUserName()) as person:
+            watchlist = person.find('watchlist')
+            if watchlist is None:
+                watchlist = ElementTree.SubElement(person, 'watchlist')
+            for node in watchlist:
+                if node.get('name') == str(project):
+                    return
+            ElementTree.SubElement(watchlist, 'project', name=str(project))
 
-        f = metafile(url, ElementTree.tostring(person))
-        f.sync()
+    def unwatchProject(self, project):
+        """
+        unwatchProject(project)
 
+        Stop watching project
+        """
+        with self.editMeta('user', self.getUserName()) as person:
+            watchlist = person.find('watchlist')
+            if watchlist is None:
+                return
+            for node in watchlist:
+                if node.get('name') == str(project):
+                    watchlist.remove(node)
+                    break
+
+    @transport.prioritized(transport.INTERACTIVE)
+    @transport.coalesced()
     def getRepoState(self, project):
         targets = {}
         results = core.show_prj_results_meta(self.apiurl, project)
@@ -471,6 +570,81 @@ class BuildService():
             targets[target] = state
         return targets
 
+    def _waitForProjectRepositories(self, project, pending, start, deadline,
+                                    interval, max_interval, settled):
+        oldstate = None
+        delay = interval
+        while pending:
+            left = deadline - time.time()
+            if left <= 0:
+                return
+            query = ['view=summary']
+            query += ['repository=%s' % quote_plus(r) for r in sorted(set(r for (r, a) in pending))]
+            query += ['arch=%s' % quote_plus(a) for a in sorted(set(a for (r, a) in pending))]
+            if oldstate:
+                # servers supporting it answer once the state changed
+                query.append('oldstate=%s' % oldstate)
+            u = core.makeurl(self.apiurl, ['build', project, '_result'], query)
+            asked = time.time()
+            try:
+                # a long poll must not hold an admission slot while it waits
+                with transport.deadline(left), transport.longpoll(bool(oldstate)):
+                    root = ElementTree.parse(core.http_GET(u)).getroot()
+            except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+                if isinstance(e, HTTPError) and not transport.is_overload(e):
+                    raise
+                # timeouts and server hiccups, try again until the deadline
+                time.sleep(min(delay, max(0, deadline - time.time())))
+                delay = min(delay * 1.5, max_interval)
+                continue
+
+            now = time.time()
+            for result in root.findall('result'):
+                target = (result.get('repository'), result.get('arch'))
+                state = result.get('state') or result.get('code')
+                if target in pending and state == 'published' and \
+                        result.get('dirty') != 'true':
+                    pending.discard(target)
+                    settled[(project,) + target] = now - start
+
+            state = root.get('state')
+            if pending and (state is None or state == oldstate) and now - asked < interval:
+                # no long polling here, back off
+                time.sleep(min(delay, max(0, deadline - time.time())))
+                delay = min(delay * 1.5, max_interval)
+            else:
+                delay = interval
+            oldstate = state
+
+    def waitForRepositories(self, targets, timeout=3600, interval=5, max_interval=60):
+        """
+        waitForRepositories(targets, timeout=3600, interval=5, max_interval=60) -> (dict, list)
+
+        Wait until all targets, a list of (project, repository, arch)
+        tuples, are published and not dirty. Each project is watched in its
+        own thread with summary results filtered to the targets still
+        pending, using long polling if the server supports it and otherwise
+        polling every 'interval' seconds growing up to 'max_interval'.
+
+        Returns (settled, timedout): settled maps the targets to the seconds
+        they took to settle, timedout lists the targets which didn't settle
+        within 'timeout' seconds
+        """
+        start = time.time()
+        deadline = start + timeout
+        pending = {}
+        for (project, repository, arch) in targets:
+            pending.setdefault(project, set()).add((repository, arch))
+        settled = {}
+        parallel_map(lambda project: self._waitForProjectRepositories(
+                         project, pending[project], start, deadline,
+                         interval, max_interval, settled),
+                     sorted(pending), len(pending))
+        timedout = sorted((project,) + target
+                          for (project, remaining) in pending.items() for target in remaining)
+        return (settled, timedout)
+
+    @transport.coalesced()
     def getResults(self, project):
         """getResults(project) -> (dict, list)
 
@@ -494,9 +668,61 @@ class BuildService():
                 results[package].append(code)
         return (results, targets)
 
+    def _resolveSrcmd5(self, project, package, revision, missingok=False):
+        # expanded srcmd5 of a package, '-' for a missing package if
+        # missingok, None if the sources can't be expanded
+        query = {'expand': 1}
+        if revision:
+            query['rev'] = revision
+        u = core.makeurl(self.apiurl, ['source', project, package], query)
+        try:
+            root = ElementTree.parse(core.http_GET(u)).getroot()
+        except urllib2.HTTPError, e:
+            if e.code == 404 and missingok:
+                return '-'
+            return None
+        srcmd5 = root.get('srcmd5')
+        if not srcmd5 or not md5_re.match(srcmd5):
+            return None
+        return srcmd5
+
+    def serverDiff(self, old_project, old_package, old_revision,
+                   new_project, new_package, new_revision,
+                   unified=False, missingok=False):
+        """
+        serverDiff(old_project, old_package, old_revision, new_project, new_package,
+                   new_revision, unified=False, missingok=False) -> str
+
+        Same as core.server_diff, with the result cached under the expanded
+        srcmd5s of both sides. Both revisions are resolved first and the
+        diff is requested between exactly those, so a cached diff never goes
+        stale.
+        """
+        new_md5 = self._resolveSrcmd5(new_project, new_package, new_revision)
+        old_md5 = None
+        if new_md5:
+            old_md5 = self._resolveSrcmd5(old_project, old_package or new_package,
+                                          old_revision, missingok)
+        if not new_md5 or not old_md5:
+            # let the server report what is wrong
+            return core.server_diff(self.apiurl, old_project, old_package, old_revision,
+                                    new_project, new_package, new_revision,
+                                    unified, missingok)
+
+        key = 'diff/%s/%s/%d' % (old_md5, new_md5, bool(unified))
+        diff = self.diffs.get(key)
+        if diff is None:
+            if old_md5 != '-':
+                old_revision = old_md5
+            diff = core.server_diff(self.apiurl, old_project, old_package, old_revision,
+                                    new_project, new_package, new_md5,
+                                    unified, missingok)
+            self.diffs.put(key, diff)
+        return diff
+
     def getDiff(self, sprj, spkg, dprj, dpkg, rev):
         diff = ''
-        diff += core.server_diff(self.apiurl, sprj, spkg, None,
+        diff += self.serverDiff(sprj, spkg, None,
                  dprj, dpkg, rev, False, True)
         return diff
 
@@ -513,6 +739,7 @@ class BuildService():
                 targets.append('%s/%s' % (repo.get('name'), arch.text))
         return targets
 
+    @transport.prioritized(transport.INTERACTIVE)
     def getPackageStatus(self, project, package):
         """
         getPackageStatus(project, package) -> dict
@@ -535,14 +762,49 @@ class BuildService():
             status[target] = code
         return status
 
+    @transport.prioritized(transport.INTERACTIVE)
+    def getPackagesStatus(self, project, packages, repository=None, arch=None):
+        """
+        getPackagesStatus(project, packages, repository=None, arch=None) -> dict
+
+        Returns the status of many packages at once, as a dict of dicts
+        mapping package names to targets to (code, details) tuples. details
+        is None if the server gave none. repository and arch may be single
+        names or lists limiting the targets.
+        """
+        if isinstance(repository, basestring):
+            repository = [repository]
+        if isinstance(arch, basestring):
+            arch = [arch]
+        filters = ['repository=%s' % quote_plus(r) for r in repository or []]
+        filters += ['arch=%s' % quote_plus(a) for a in arch or []]
+
+        packages = list(packages)
+        status = dict((package, {}) for package in packages)
+        for chunk in chunked(packages, 'package'):
+            query = ['package=%s' % quote_plus(p) for p in chunk] + filters
+            u = core.makeurl(self.apiurl, ['build', project, '_result'], query)
+            target = None
+            for event, node in ElementTree.iterparse(core.http_GET(u), events=('start', 'end')):
+                if node.tag == 'result' and event == 'start':
+                    target = '/'.join((node.get('repository'), node.get('arch')))
+                elif node.tag == 'status' and event == 'end':
+                    details = node.find('details')
+                    if details is not None:
+                        details = details.text
+                    status.setdefault(node.get('package'), {})[target] = (node.get('code'), details)
+                elif node.tag == 'result' and event == 'end':
+                    node.clear()
+        return status
+
     def getProjectDiff(self, src_project, dst_project):
         packages = self.getPackageList(src_project)
         for src_package in packages:
-            diff = core.server_diff(self.apiurl,
-                                dst_project, src_package, None,
-                                src_project, src_package, None, False)
+            diff = self.serverDiff(dst_project, src_package, None,
+                                   src_project, src_package, None, False)
             print diff
 
+    @transport.coalesced()
     def getPackageList(self, prj, deleted=None):
         query = {}
         if deleted:
@@ -569,7 +831,31 @@ class BuildService():
         Get binary 'file' for 'project' and 'target' and save it as 'path'
         """
         (repo, arch) = target.split('/')
+        key = None
+        if self.cache:
+            hdrmd5 = self.getBinaryChecksums(project, target, package).get(file)
+            if hdrmd5:
+                key = 'binary/%s/%s' % (hdrmd5, file)
+                if self.cache.getFile(key, path):
+                    return
+
         core.get_binary_file(self.apiurl, project, repo, arch, file, target_filename=path, package=package)
+        if key:
+            self.cache.putFile(key, path)
+
+    def getBinaryChecksums(self, project, target, package):
+        """
+        getBinaryChecksums(project, target, package) -> dict
+
+        Returns a dict of binary file names and their header md5 for a
+        particular target and package
+        """
+        (repo, arch) = target.split('/')
+        u = core.makeurl(self.apiurl, ['build', project, repo, arch, package],
+                         query={'view': 'binaryversions'})
+        root = ElementTree.parse(core.http_GET(u)).getroot()
+        return dict((node.get('name'), node.get('hdrmd5'))
+                    for node in root.findall('binary') if node.get('hdrmd5'))
 
     def getBinaryInfo(self, project, target, package, binary, ext=False):
         """
@@ -607,6 +893,104 @@ class BuildService():
         u = core.makeurl(self.apiurl, ['build', project, repo, arch, package, '_log?nostream=1&start=%s' % offset])
         return core.http_GET(u).read()
 
+    def _scanBuildLog(self, project, target, package, patterns, max_hits, chunk_size):
+        (repo, arch) = target.split('/')
+
+        def match(line, offset):
+            for (category, regex) in patterns:
+                if regex.search(line):
+                    hits.append((category, offset, line))
+                    return
+
+        hits = []
+        offset = 0
+        # incomplete last line and its offset, a line cut by a chunk boundary
+        # is only matched once the next chunk completes it
+        rest = ''
+        pos = 0
+        while len(hits) < max_hits:
+            query = ['nostream=1', 'start=%d' % offset, 'end=%d' % (offset + chunk_size)]
+            u = core.makeurl(self.apiurl, ['build', project, repo, arch, package, '_log'], query)
+            f = core.http_GET(u)
+            received = 0
+            while len(hits) < max_hits:
+                buf = f.read(64 * 1024)
+                if not buf:
+                    break
+                received += len(buf)
+                lines = (rest + buf).split('\n')
+                rest = lines.pop()
+                for line in lines:
+                    match(line, pos)
+                    pos += len(line) + 1
+                    if len(hits) >= max_hits:
+                        break
+            f.close()
+            offset += received
+            if received < chunk_size:
+                break
+        if rest and len(hits) < max_hits:
+            match(rest, pos)
+        return hits
+
+    def scanBuildLogs(self, project, filter_code='failed', patterns=None, targets=None,
+                      max_hits=1, chunk_size=1024*1024, workers=8):
+        """
+        scanBuildLogs(project, filter_code='failed', patterns=None, targets=None,
+                      max_hits=1, chunk_size=1024*1024, workers=8) -> generator of dicts
+
+        Find the packages of a project with result code filter_code with a
+        single results query and scan their build logs for known failures.
+        patterns is a list of (category, regex) pairs tried in order on each
+        log line, LOG_PATTERNS by default. targets optionally limits the
+        'repo/arch' targets to look at.
+
+        Logs are fetched in chunks of chunk_size bytes, 'workers' at a time,
+        and each log is only read until max_hits of its lines matched. For
+        every log a dict with the keys 'package', 'target', 'code',
+        'category', 'hits' and 'error' is yielded as soon as it is scanned.
+        'hits' is a list of (category, offset, line) tuples, 'category' the
+        category of the first hit, None if nothing matched. 'error' is the
+        exception raised when the log could not be read, None otherwise.
+        """
+        if patterns is None:
+            patterns = LOG_PATTERNS
+        patterns = [(category, re.compile(regex) if isinstance(regex, basestring) else regex)
+                    for (category, regex) in patterns]
+
+        query = ['code=%s' % quote_plus(filter_code)]
+        u = core.makeurl(self.apiurl, ['build', project, '_result'], query)
+        failures = []
+        target = None
+        for event, node in ElementTree.iterparse(core.http_GET(u), events=('start', 'end')):
+            if node.tag == 'result' and event == 'start':
+                target = '/'.join((node.get('repository'), node.get('arch')))
+            elif node.tag == 'status' and event == 'end':
+                if node.get('code') == filter_code and (targets is None or target in targets):
+                    failures.append((node.get('package'), target, node.get('code')))
+            elif node.tag == 'result' and event == 'end':
+                node.clear()
+
+        def scan(failure):
+            (package, target, code) = failure
+            (hits, error) = ([], None)
+            try:
+                with transport.priority(transport.BULK, override=False):
+                    hits = self._scanBuildLog(project, target, package, patterns,
+                                              max_hits, chunk_size)
+            except Exception as e:
+                # one missing log must not end the scan
+                error = e
+            return {'package': package,
+                    'target': target,
+                    'code': code,
+                    'category': hits[0][0] if hits else None,
+                    'hits': hits,
+                    'error': error}
+
+        for record in transport.parallel_imap(scan, failures, workers):
+            yield record
+
     def getWorkerStatus(self):
         """
         getWorkerStatus() -> list of dicts
@@ -728,64 +1112,149 @@ class BuildService():
             arch = None
         return core.abortbuild(self.apiurl, project, package, arch, repo)
 
-    def getBuildHistory(self, project, package, target):
+    def _buildCommandMany(self, cmd, project, packages, targets, query,
+                          dry_run, workers):
+        # Group the (package, target) pairs by target, a target of None
+        # meaning all of them
+        groups = {}
+        order = []
+        for item in packages:
+            if isinstance(item, basestring):
+                pairs = [(item, target) for target in (targets or [None])]
+            else:
+                pairs = [tuple(item)]
+            for (package, target) in pairs:
+                if target not in groups:
+                    groups[target] = []
+                    order.append(target)
+                if package not in groups[target]:
+                    groups[target].append(package)
+
+        # Several package= parameters per POST, as many as fit in the URL
+        calls = []
+        for target in order:
+            base = ['cmd=%s' % cmd] + ['%s=%s' % (k, quote_plus(str(v))) for (k, v) in query]
+            if target:
+                (repo, arch) = target.split('/')
+                base += ['repository=%s' % quote_plus(repo), 'arch=%s' % quote_plus(arch)]
+            for chunk in chunked(groups[target], 'package'):
+                calls.append((target, chunk, base))
+
+        def url(base, chunk):
+            return core.makeurl(self.apiurl, ['build', project],
+                                base + ['package=%s' % quote_plus(p) for p in chunk])
+
+        if dry_run:
+            return [(url(call_base, call_chunk), call_target, call_chunk)
+                    for (call_target, call_chunk, call_base) in calls]
+
+        def post(call):
+            (target, chunk, base) = call
+            outcome = {}
+            try:
+                core.http_POST(url(base, chunk))
+                for package in chunk:
+                    outcome[(package, target)] = True
+            except Exception as e:
+                if len(chunk) == 1 or not isinstance(e, HTTPError):
+                    # the server could not be asked at all
+                    for package in chunk:
+                        outcome[(package, target)] = e
+                    return outcome
+                # Find out which package spoiled the batch
+                for package in chunk:
+                    try:
+                        core.http_POST(url(base, [package]))
+                        outcome[(package, target)] = True
+                    except Exception as e:
+                        outcome[(package, target)] = e
+            return outcome
+
+        result = {}
+        with transport.priority(transport.BULK, override=False):
+            for outcome in parallel_map(post, calls, workers):
+                result.update(outcome)
+        return result
+
+    def rebuildMany(self, project, packages, targets=None, code=None,
+                    dry_run=False, workers=4):
+        """
+        rebuildMany(project, packages, targets=None, code=None, dry_run=False, workers=4) -> dict
+
+        Rebuild many packages in 'project'. packages contains package names,
+        which are rebuilt for every target in 'targets' (all targets if not
+        given), or (package, target) pairs. Duplicates are dropped and the
+        packages of each target are rebuilt with as few requests as possible,
+        'workers' of them at a time. If 'code' is specified, only targets with
+        that code are rebuilt.
+
+        Returns a dict with (package, target) keys and True or the exception
+        of the failed rebuild as values. With dry_run=True nothing is rebuilt,
+        a list of the planned (url, target, packages) calls is returned instead.
+        """
+        query = []
+        if code:
+            query.append(('code', code))
+        return self._buildCommandMany('rebuild', project, packages, targets,
+                                      query, dry_run, workers)
+
+    def abortMany(self, project, packages, targets=None, dry_run=False, workers=4):
+        """
+        abortMany(project, packages, targets=None, dry_run=False, workers=4) -> dict
+
+        Abort the builds of many packages in 'project', the arguments and
+        the result are the same as for rebuildMany()
+        """
+        return self._buildCommandMany('abortbuild', project, packages, targets,
+                                      [], dry_run, workers)
+
+    def getBuildHistory(self, project, package, target, since=None):
         """
-        getBuildHistory(project, package, target) -> list
+        getBuildHistory(project, package, target, since=None) -> list
 
         Get build history of package for target as a list of tuples of the form
         (time, srcmd5, rev, versrel, bcnt)
-        """
-        (repo, arch) = target.split('/')
-        u = core.makeurl(self.apiurl, ['build', project, repo, arch, package, '_history'])
-        f = core.http_GET(u)
-        root = ElementTree.parse(f).getroot()
 
+        If since is set (seconds since the epoch), only builds finished after
+        that time are returned. Entries are cached, only new ones are fetched.
+        """
         r = []
-        for node in root.findall('entry'):
-            rev = int(node.get('rev'))
-            srcmd5 = node.get('srcmd5')
-            versrel = node.get('versrel')
-            bcnt = int(node.get('bcnt'))
-            t = time.localtime(int(node.get('time')))
-            t = time.strftime('%Y-%m-%d %H:%M:%S', t)
-
+        for (t, srcmd5, rev, versrel, bcnt) in self.history.builds(project, package, target):
+            if since and t <= since:
+                continue
+            t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
             r.append((t, srcmd5, rev, versrel, bcnt))
         return r
 
-    def getCommitLog(self, project, package, revision=None):
+    def getCommitLog(self, project, package, revision=None, since_rev=None):
         """
-        getCommitLog(project, package, revision=None) -> list
+        getCommitLog(project, package, revision=None, since_rev=None) -> list
 
         Get commit log for package in project. If revision is set, get just the
-        log for that revision.
+        log for that revision. If since_rev is set, get just the revisions
+        newer than revision number since_rev.
 
         Each log is a tuple of the form (rev, srcmd5, version, time, user,
         comment)
+
+        Entries are cached, only new revisions are fetched from the server.
         """
-        u = core.makeurl(self.apiurl, ['source', project, package, '_history'])
-        f = core.http_GET(u)
-        root = ElementTree.parse(f).getroot()
+        if revision:
+            entry = self.history.commit(project, package, revision)
+            entries = [entry] if entry else []
+        else:
+            entries = self.history.commits(project, package)
+            entries.reverse()
 
         r = []
-        revisions = root.findall('revision')
-        revisions.reverse()
-        for node in revisions:
-            rev = int(node.get('rev'))
-            if revision and rev != int(revision):
+        for (rev, srcmd5, version, t, user, comment) in entries:
+            if since_rev and rev <= int(since_rev):
                 continue
-            srcmd5 = node.find('srcmd5').text
-            version = node.find('version').text
-            user = node.find('user').text
-            try:
-                comment = node.find('comment').text
-            except:
-                comment = '<no message>'
-            t = time.localtime(int(node.find('time').text))
-            t = time.strftime('%Y-%m-%d %H:%M:%S', t)
-
+            t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
             r.append((rev, srcmd5, version, t, user, comment))
         return r
 
+    @transport.coalesced()
     def getProjectMeta(self, project):
         """
         getProjectMeta(project) -> string
@@ -853,7 +1322,8 @@ class BuildService():
             core.delete_project(self.apiurl, project)
         except Exception:
             return False
-            
+
+        self.projects.discard(project)
         return True
 
     def getPackageMeta(self, project, package):
@@ -1054,6 +1524,7 @@ class BuildService():
                     archs.append("%s" % (arch.text))
         return archs
 
+    @transport.prioritized(transport.INTERACTIVE)
     def isPackageSucceeded(self, project, repository, pkg, arch):
         results = core.get_package_results(self.apiurl, project, pkg, 
                                            repository = [repository],
@@ -1086,6 +1557,123 @@ class BuildService():
         tree =  ElementTree.fromstring(''.join(xml))
         return tree.get("rev")
 
+    def getProjectSourceInfo(self, project, packages=None):
+        """
+        getProjectSourceInfo(project, packages=None) -> dict
+
+        Returns the source info of all packages in project, or only of the
+        given packages, with a single listing (view=info). The result maps
+        package names to dicts with the keys 'rev', 'srcmd5', 'verifymd5'
+        and, for links, 'lsrcmd5' (the unexpanded srcmd5). Packages whose
+        sources can't be expanded have an 'error' key.
+        """
+        if packages is None:
+            chunks = [None]
+        else:
+            chunks = list(chunked(packages, 'package'))
+
+        info = {}
+        for chunk in chunks:
+            query = ['view=info', 'nofilename=1']
+            if chunk:
+                query += ['package=%s' % quote_plus(p) for p in chunk]
+            u = core.makeurl(self.apiurl, ['source', project], query)
+            for event, node in ElementTree.iterparse(core.http_GET(u)):
+                if node.tag == 'sourceinfo':
+                    d = dict(node.items())
+                    package = d.pop('package')
+                    error = node.find('error')
+                    if error is not None:
+                        d['error'] = error.text
+                    info[package] = d
+                    node.clear()
+        return info
+
+    def _copyPackage(self, src_project, package, dst_project, client_side_copy=False,
+                     keep_maintainers=False, keep_develproject=False, expand=False,
+                     revision=None, comment=None, force_meta_update=None, keep_link=None):
+        # osc.core.copy_pac, but the meta names the user of this instance
+        # instead of the one of the osc globals
+        if src_project != dst_project:
+            meta = core.show_package_meta(self.apiurl, src_project, package)
+            meta = core.replace_pkg_meta(meta, package, dst_project, keep_maintainers,
+                                         self.getUserName(), keep_develproject)
+            u = core.makeurl(self.apiurl, ['source', dst_project, package, '_meta'])
+            found = None
+            try:
+                found = core.http_GET(u).read()
+            except HTTPError:
+                pass
+            if force_meta_update or not found:
+                core.http_PUT(u, data=meta)
+        if client_side_copy:
+            # the meta is in place now, copy_pac leaves it alone
+            return core.copy_pac(self.apiurl, src_project, package,
+                                 self.apiurl, dst_project, package,
+                                 client_side_copy=True, expand=expand,
+                                 revision=revision, comment=comment)
+        query = {'cmd': 'copy', 'oproject': src_project, 'opackage': package}
+        if expand or keep_link:
+            query['expand'] = '1'
+        if keep_link:
+            query['keeplink'] = '1'
+        if revision:
+            query['orev'] = revision
+        if comment:
+            query['comment'] = comment
+        u = core.makeurl(self.apiurl, ['source', dst_project, package], query=query)
+        return core.http_POST(u).read()
+
+    def copyPackages(self, src_project, dst_project, packages=None, workers=4, **kwargs):
+        """
+        copyPackages(src_project, dst_project, packages=None, workers=4, **kwargs) -> dict
+
+        Copy packages (all packages by default) from src_project to
+        dst_project. Packages whose sources are the same in both projects
+        are skipped, the others are copied 'workers' at a time. Additional
+        keyword arguments are those of osc.core.copy_pac, like comment or
+        keep_link.
+
+        Returns a dict mapping package names to dicts with the keys 'status'
+        ('copied', 'unchanged' or 'failed'), 'seconds' and, for failures,
+        'error'.
+        """
+        if packages is None:
+            packages = self.getPackageList(src_project)
+        src_info = self.getProjectSourceInfo(src_project, packages)
+        try:
+            dst_info = self.getProjectSourceInfo(dst_project, packages)
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            dst_info = {}
+
+        def checksum(info):
+            # links are copied unexpanded
+            if info is None:
+                return None
+            return info.get('lsrcmd5', info.get('srcmd5'))
+
+        def copy(package):
+            start = time.time()
+            report = {}
+            src = checksum(src_info.get(package))
+            if src and src == checksum(dst_info.get(package)):
+                report['status'] = 'unchanged'
+            else:
+                try:
+                    self._copyPackage(src_project, package, dst_project, **kwargs)
+                    report['status'] = 'copied'
+                except Exception as e:
+                    report['status'] = 'failed'
+                    report['error'] = e
+            report['seconds'] = time.time() - start
+            return (package, report)
+
+        with transport.priority(transport.BULK, override=False):
+            return dict(parallel_map(copy, packages, workers))
+
+    @transport.prioritized(transport.INTERACTIVE)
     def getServiceState(self, project, pkg):
         try:
             xml = core.show_files_meta(self.apiurl, project, pkg, expand=True)
@@ -1106,14 +1694,141 @@ class BuildService():
             break
         return status
 
+    def getServiceStates(self, project, packages=None, bulk=False, workers=8):
+        """
+        getServiceStates(project, packages=None, bulk=False, workers=8) -> dict
+
+        Returns the source service state of all packages in project, or of
+        the given packages, as a dict mapping package names to the states
+        getServiceState() reports. The packages are checked 'workers' at a
+        time.
+
+        With bulk=True the states are taken from a single source info
+        listing instead, which is much cheaper but relies on the server
+        reporting service errors in it.
+        """
+        if bulk:
+            states = {}
+            for (package, info) in self.getProjectSourceInfo(project, packages).items():
+                error = info.get('error')
+                if not error:
+                    states[package] = 'succeeded'
+                elif 'service in progress' in error:
+                    states[package] = 'running'
+                elif 'service' in error and ('failed' in error or 'error' in error):
+                    states[package] = 'failed'
+                else:
+                    states[package] = error
+            return states
+
+        # one request per package, don't let them crowd out interactive ones
+        with transport.priority(transport.BULK, override=False):
+            if packages is None:
+                packages = self.getPackageList(project)
+            return dict(parallel_map(lambda package: (package, self.getServiceState(project, package)),
+                                     packages, workers))
+
+    def waitForServices(self, project, packages=None, timeout=600, interval=2,
+                        max_interval=30, bulk=False):
+        """
+        waitForServices(project, packages=None, timeout=600, interval=2, max_interval=30, bulk=False) -> dict
+
+        Wait until the source services of all packages in project, or of the
+        given packages, are not running anymore. Only the packages still
+        running are polled again, with the poll interval growing from
+        'interval' up to 'max_interval' seconds.
+
+        Returns the last known states, packages still 'running' after
+        'timeout' seconds are left as such.
+        """
+        deadline = time.time() + timeout
+        states = self.getServiceStates(project, packages, bulk=bulk)
+        while True:
+            running = [package for (package, state) in states.items() if state == 'running']
+            if not running or time.time() >= deadline:
+                return states
+            time.sleep(min(interval, max(0, deadline - time.time())))
+            interval = min(interval * 1.5, max_interval)
+            states.update(self.getServiceStates(project, running, bulk=bulk))
+
     def getPackageFileList(self, project, pkg, revision=None):
         if not revision:
             revision = self.getPackageRev(project, pkg)
 
-        return core.meta_get_filelist(self.apiurl, project, pkg,
-                                          expand=True, revision=revision)
+        (srcmd5, files) = self._fileListing(project, pkg, revision)
+        return [name for (name, md5) in files]
+
+    def _fileListing(self, project, pkg, revision, expand=True, cached_only=False):
+        # (srcmd5, [(name, md5)]) of the sources at revision. Expanded
+        # listings are cached under the srcmd5 of the expansion, which only
+        # a revision naming exactly these sources hits: the srcmd5 of a link
+        # expands against whatever its target is now. (None, None) if
+        # cached_only and the listing is not cached
+        if expand and self.cache and revision and md5_re.match(str(revision)):
+            data = self.cache.get('files/%s/%s/%s' % (project, pkg, revision))
+            if data is not None:
+                return (revision, [tuple(reversed(line.split(' ', 1)))
+                                   for line in data.split('\n') if line])
+        if cached_only:
+            return (None, None)
+
+        xml = core.show_files_meta(self.apiurl, project, pkg,
+                                   revision=revision, expand=expand)
+        root = ElementTree.fromstring(''.join(xml))
+        srcmd5 = root.get('srcmd5')
+        files = [(node.get('name'), node.get('md5')) for node in root.findall('entry')]
+        if expand and self.cache and srcmd5 and md5_re.match(srcmd5):
+            self.cache.put('files/%s/%s/%s' % (project, pkg, srcmd5),
+                           '\n'.join('%s %s' % (md5, name) for (name, md5) in files))
+        return (srcmd5, files)
+
+    def _getCachedFile(self, project, pkg, filename, revision, expand):
+        # Files are cached by their md5 from the listing, but only where
+        # finding it takes no more requests than getFile() without a cache.
+        # Returns None for files that can't be cached that cheaply
+        if revision and md5_re.match(str(revision)):
+            if not expand:
+                # the unexpanded sources at a srcmd5 never change
+                key = 'srcfile/%s/%s' % (revision, filename)
+                data = self.cache.get(key)
+                if data is None:
+                    u = core.makeurl(self.apiurl, ['source', project, pkg, quote(filename)],
+                                     query={'rev': revision, 'expand': 0})
+                    data = ''.join(core.streamfile(u))
+                    self.cache.put(key, data)
+                return data
+            (srcmd5, files) = self._fileListing(project, pkg, revision, cached_only=True)
+            if files is None:
+                return None
+        elif revision:
+            # a revision number, the file alone is a single request
+            return None
+        else:
+            # the listing takes the place of looking up the revision
+            (srcmd5, files) = self._fileListing(project, pkg, None, bool(expand))
+
+        u = core.makeurl(self.apiurl, ['source', project, pkg, quote(filename)],
+                         query={'rev': srcmd5})
+        md5 = dict(files).get(filename)
+        if not md5:
+            raise HTTPError(u, 404, "File %s not found in %s/%s" % (filename, project, pkg),
+                            None, None)
+
+        key = 'file/%s' % md5
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        data = ''.join(core.streamfile(u))
+        if hashlib.md5(data).hexdigest() == md5:
+            self.cache.put(key, data)
+        return data
 
     def getFile(self, project, pkg, filename, revision=None, expand=1):
+        if self.cache:
+            data = self._getCachedFile(project, pkg, filename, revision, expand)
+            if data is not None:
+                return data
+
         data = ""
         if not revision:
             revision = self.getPackageRev(project, pkg)
@@ -1132,6 +1847,170 @@ class BuildService():
             data += chunks
         return data
 
+    def _sourceListing(self, project, package, revision, expand):
+        # (srcmd5, [(name, md5, size, mtime)]) of the sources at revision
+        query = {'rev': revision}
+        if expand:
+            query['expand'] = 1
+        u = core.makeurl(self.apiurl, ['source', project, package], query)
+        root = ElementTree.parse(core.http_GET(u)).getroot()
+        return (root.get('srcmd5'),
+                [(e.get('name'), e.get('md5'), int(e.get('size')), int(e.get('mtime') or 0))
+                 for e in root.findall('entry')])
+
+    def _fetchSource(self, project, package, srcmd5, name, md5, path):
+        # download a source file to path, checking its md5. An existing file
+        # is replaced, writing to it would change the files hard linked to it.
+        key = 'file/%s' % md5
+        if self.cache and self.cache.getFile(key, path):
+            return
+        u = core.makeurl(self.apiurl, ['source', project, package, quote(name)],
+                         query={'rev': srcmd5})
+        f = core.http_GET(u)
+        digest = hashlib.md5()
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp.', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    buf = f.read(core.BUFSIZE)
+                    if not buf:
+                        break
+                    digest.update(buf)
+                    out.write(buf)
+            if digest.hexdigest() != md5:
+                raise IOError('%s/%s/%s: got md5 %s instead of %s'
+                              % (project, package, name, digest.hexdigest(), md5))
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, path)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+        if self.cache:
+            self.cache.putFile(key, path)
+
+    def exportProjectSources(self, project, dest, revisions=None, format='dir', workers=8):
+        """
+        exportProjectSources(project, dest, revisions=None, format='dir', workers=8) -> dict
+
+        Export the sources of all packages of project. The srcmd5 of every
+        package is pinned by a single listing of the project, revisions
+        optionally maps package names to other revisions to export. Files
+        are downloaded 'workers' at a time and files with the same md5 are
+        only downloaded and stored once.
+
+        With format 'dir' the sources are written to dest/<package>/<file>,
+        identical files are hard linked. Files left in dest/<package> by an
+        earlier export which are no longer part of the package are removed,
+        directories of packages no longer in project are left alone. With
+        format 'tar', 'tar.gz' or 'tar.bz2' they are written as a tar stream
+        to dest, a path or a file object, identical files become hard link
+        members.
+
+        Returns a dict mapping the package names to the exported srcmd5,
+        None for packages whose sources can't be expanded.
+        """
+        revisions = revisions or {}
+        pinned = {}
+        exported = {}
+        for (package, info) in self.getProjectSourceInfo(project).items():
+            if package in revisions:
+                pinned[package] = (revisions[package], True)
+            elif 'error' in info:
+                exported[package] = None
+            else:
+                pinned[package] = (info['srcmd5'], False)
+        for package in revisions:
+            pinned.setdefault(package, (revisions[package], True))
+
+        listings = dict(parallel_map(
+            lambda p: (p, self._sourceListing(project, p, *pinned[p])), sorted(pinned), workers))
+
+        # md5 -> [(package, srcmd5, name, size, mtime)], the first one is fetched
+        blobs = {}
+        for package in sorted(listings):
+            (srcmd5, entries) = listings[package]
+            exported[package] = srcmd5
+            for (name, md5, size, mtime) in sorted(entries):
+                blobs.setdefault(md5, []).append((package, srcmd5, name, size, mtime))
+
+        if format == 'dir':
+            for package in listings:
+                path = os.path.join(dest, package)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+
+            def fetch(md5):
+                (package, srcmd5, name, size, mtime) = blobs[md5][0]
+                first = os.path.join(dest, package, name)
+                self._fetchSource(project, package, srcmd5, name, md5, first)
+                for (package, srcmd5, name, size, mtime) in blobs[md5][1:]:
+                    path = os.path.join(dest, package, name)
+                    # link under a temporary name, os.link can't replace path
+                    tmpname = os.path.join(dest, package, '.tmp.%s' % name)
+                    if os.path.lexists(tmpname):
+                        os.unlink(tmpname)
+                    try:
+                        os.link(first, tmpname)
+                    except OSError:
+                        shutil.copyfile(first, tmpname)
+                    os.rename(tmpname, path)
+
+            with transport.priority(transport.BULK, override=False):
+                parallel_map(fetch, sorted(blobs), workers)
+
+            for (package, (srcmd5, entries)) in listings.items():
+                names = set(entry[0] for entry in entries)
+                path = os.path.join(dest, package)
+                for name in os.listdir(path):
+                    stale = os.path.join(path, name)
+                    if name not in names and not os.path.isdir(stale):
+                        os.unlink(stale)
+            return exported
+
+        if format not in ('tar', 'tar.gz', 'tar.bz2'):
+            raise ValueError('unknown export format %s' % format)
+        mode = 'w|' + format[4:]
+        if isinstance(dest, basestring):
+            tar = tarfile.open(dest, mode)
+        else:
+            tar = tarfile.open(fileobj=dest, mode=mode)
+        # downloads are staged on disk, only the tar stream is sequential.
+        # At most 'workers' of them are staged at a time.
+        staging = tempfile.mkdtemp(prefix='.export.')
+
+        def fetch(md5):
+            (package, srcmd5, name, size, mtime) = blobs[md5][0]
+            path = os.path.join(staging, md5)
+            self._fetchSource(project, package, srcmd5, name, md5, path)
+            return md5
+
+        try:
+            with transport.priority(transport.BULK, override=False):
+                md5s = sorted(blobs)
+                batch = max(workers, 1)
+                for start in range(0, len(md5s), batch):
+                    for md5 in parallel_map(fetch, md5s[start:start + batch], workers):
+                        path = os.path.join(staging, md5)
+                        first = None
+                        for (package, srcmd5, name, size, mtime) in blobs[md5]:
+                            member = tarfile.TarInfo('%s/%s' % (package, name))
+                            member.mtime = mtime
+                            member.mode = 0644
+                            if first is None:
+                                member.size = os.path.getsize(path)
+                                with open(path, 'rb') as f:
+                                    tar.addfile(member, f)
+                                first = member.name
+                            else:
+                                member.type = tarfile.LNKTYPE
+                                member.linkname = first
+                                tar.addfile(member)
+                        os.unlink(path)
+        finally:
+            tar.close()
+            shutil.rmtree(staging, ignore_errors=True)
+        return exported
+
     def isType(self, name, is_type):
         try:
             u = core.makeurl(self.apiurl, [is_type, name])
@@ -1142,12 +2021,26 @@ class BuildService():
                 return False
             raise
 
+    def _projectExists(self, name):
+        # The catalog may be minutes old, ask the server about projects
+        # it does not know yet
+        if self.projects.exists(name):
+            return True
+        try:
+            core.http_GET(core.makeurl(self.apiurl, ['source', name, '_meta'])).close()
+        except HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        self.projects.add(name)
+        return True
+
     def getType(self, name):
         if self.isType(name, "group"):
             objtype = "group"
         elif self.isType(name, "person"):
             objtype = "user"
-        elif name in self.getProjectList():
+        elif self._projectExists(name):
             objtype = "project"
         else:
             objtype = "unknown"
@@ -1195,6 +2088,7 @@ class BuildService():
     def wipeBinaries(self, project):
         core.wipebinaries(self.apiurl, project)
 
+    @transport.prioritized(transport.INTERACTIVE)
     def getPackageResults(self, project, repository, pkg, arch):
         return core.get_package_results(self.apiurl, project, pkg,
                                         repository=[repository],
@@ -1217,6 +2111,7 @@ class BuildService():
                             return repo
         return False
 
+    @transport.coalesced()
     def getProjectResults(self, project):
         results = core.show_prj_results_meta(self.apiurl, project)
         if not results:
@@ -1247,97 +2142,134 @@ class BuildService():
     def createProjectLink(self, link_source, repolinks, link_target, flags=[]):
         return self.createProject(link_target, repolinks, links=[link_source], flags=flags)
 
-    def createProject(self, name, repos, links=None, paths=None, build=True,
-                      publish=True, mechanism="localdep", flags=[], maintainers=None,
-                      desc="", title="", block="all", rebuild="transitive"):
-        repositories = ""
+    def _projectMeta(self, name, repos, links=None, paths=None, build=True,
+                     publish=True, mechanism="localdep", flags=[], maintainers=None,
+                     desc="", title="", block="all", rebuild="transitive"):
+        project = ElementTree.Element('project', name=name)
+        ElementTree.SubElement(project, 'title').text = title or name
+        ElementTree.SubElement(project, 'description').text = desc
+
+        for maint in maintainers or []:
+            ElementTree.SubElement(project, 'person', role='maintainer', userid=maint)
+        for link in links or []:
+            ElementTree.SubElement(project, 'link', project=link)
+
+        for flag in flags or []:
+            # flags may be lxml elements
+            if hasattr(flag, 'getroottree'):
+                from lxml import etree
+                flag = ElementTree.fromstring(etree.tostring(flag))
+            else:
+                flag = ElementTree.fromstring(ElementTree.tostring(flag))
+            if flag.tag == "build" and not build:
+                ElementTree.SubElement(flag, "disable")
+            if flag.tag == "publish" and not publish:
+                ElementTree.SubElement(flag, "disable")
+            project.append(flag)
+
         for repo, archs in repos.iteritems():
-            arch_string = ""
-            for arch in archs:
-                arch_string += "    <arch>%s</arch>" % arch
             path_elements = []
             if paths and repo in paths:
                 for path in paths[repo]:
-                    path_string = path_template % dict(
-                        project=path[0],
-                        repository=path[1],
-                    )
-                    if path[2] in archs and path_string not in path_elements:
-                        path_elements.append(path_string)
-            mechanism_string = ""
+                    if path[2] in archs and (path[0], path[1]) not in path_elements:
+                        path_elements.append((path[0], path[1]))
+            repository = ElementTree.SubElement(project, 'repository', name=repo)
             if links:
                 for link in links:
-                    link_path_string = path_template % dict(
-                        project=link,
-                        repository=repo,
-                    )
-                    if link_path_string not in path_elements:
-                        path_elements.insert(0, link_path_string)
-
-                mechanism_string = 'linkedbuild="%s"' % mechanism
-            repositories += repo_template % dict(
-                repository=repo,
-                mechanism=mechanism_string,
-                paths="\n".join(path_elements),
-                archs=arch_string,
-                block=block,
-                rebuild=rebuild,
-                )
-        build_string = ""
-        #if not build:
-        #    build_string = "<build><disable/></build>"
-        #publish_string = ""
-        #if not publish:
-        #    publish_string = "<publish><disable/></publish>"
-        link_string = ""
-        if links:
-            for link in links:
-                link_string += '<link project="%s"/>\n' % link
-
-        from lxml import etree
-        flags_list = []
-        if flags:
-            for flag in flags:
-                if flag.tag == "build" and not build:
-                    etree.SubElement(flag, "disable")
-                if flag.tag == "publish" and not publish:
-                    etree.SubElement(flag, "disable")
-                flags_list.append(etree.tostring(flag))
-            
-        flags_string = "\n".join(flags_list)
-
-        maint_string = ""
-        if maintainers:
-            for maint in maintainers:
-                maint_string +='<person role="maintainer" userid="%s" />\n' % maint
-
-        if title:
-            title = cgi.escape(title)
-        if desc:
-            desc = cgi.escape(desc)
-
-        meta = prj_template % dict(
-            name=name,
-            user=self.getUserName(),
-            title=title or name,
-            description=desc,
-            link=link_string,
-            #build=build_string,
-            #publish=publish_string,
-            repositories=repositories,
-            flags=flags_string,
-            maintainers=maint_string,
-            )
-        u = core.makeurl(self.apiurl, ['source', name, '_meta'])
+                    if (link, repo) not in path_elements:
+                        path_elements.insert(0, (link, repo))
+                repository.set('linkedbuild', mechanism)
+            repository.set('block', block)
+            repository.set('rebuild', rebuild)
+            for (path_project, path_repository) in path_elements:
+                ElementTree.SubElement(repository, 'path', project=path_project,
+                                       repository=path_repository)
+            for arch in archs:
+                ElementTree.SubElement(repository, 'arch').text = arch
+
+        return project
+
+    @staticmethod
+    def _canonicalMeta(node, tags=None):
+        # OBS may reorder elements of different kinds and whitespace, only the
+        # order of same kind siblings (like repository paths) matters. With
+        # tags, only top level elements of those kinds are compared.
+        children = sorted([BuildService._canonicalMeta(child) for child in node
+                           if tags is None or child.tag in tags],
+                          key=lambda child: child[0])
+        return (node.tag, tuple(sorted(node.items())), (node.text or '').strip(),
+                tuple(children))
+
+    def _ensureProjectMeta(self, name, meta):
+        try:
+            current = ElementTree.fromstring(self.getProjectMeta(name))
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            current = None
+
+        # the server adds elements of its own, like the creator as maintainer
+        tags = set(child.tag for child in meta)
+        if current is not None and \
+                self._canonicalMeta(current, tags) == self._canonicalMeta(meta, tags):
+            return 'unchanged'
 
-        print meta.encode('utf-8')
-        f = core.http_PUT(u, data=meta)
+        u = core.makeurl(self.apiurl, ['source', name, '_meta'])
+        f = core.http_PUT(u, data=ElementTree.tostring(meta, encoding='utf-8'))
         root = ElementTree.parse(f).getroot()
-        ret = root.get('code')
-        if ret == "ok":
-            return True
-        else:
-            return False
+        if root.get('code') != "ok":
+            return None
+        self.projects.add(name)
+        if current is None:
+            return 'created'
+        return 'updated'
+
+    def createProject(self, name, repos, links=None, paths=None, build=True,
+                      publish=True, mechanism="localdep", flags=[], maintainers=None,
+                      desc="", title="", block="all", rebuild="transitive"):
+        """
+        createProject(name, repos, links=None, paths=None, build=True, publish=True,
+                      mechanism="localdep", flags=[], maintainers=None, desc="",
+                      title="", block="all", rebuild="transitive") -> Bool
+
+        Create or update project 'name'. repos maps repository names to
+        lists of archs, paths maps repository names to lists of
+        (project, repository, arch) tuples.
+
+        The meta is only sent when it differs from the current one on the
+        server. Returns True on success
+        """
+        meta = self._projectMeta(name, repos, links, paths, build, publish,
+                                 mechanism, flags, maintainers, desc, title,
+                                 block, rebuild)
+        return self._ensureProjectMeta(name, meta) is not None
+
+    def ensureProjects(self, specs, workers=4):
+        """
+        ensureProjects(specs, workers=4) -> dict
+
+        Reconcile many projects, 'workers' at a time. specs is a list of
+        dicts with the keyword arguments of createProject().
+
+        Returns a dict mapping project names to 'created', 'updated',
+        'unchanged', None if the server refused the meta or the exception
+        raised for that project. Raises ValueError before changing anything
+        if a spec has no 'name'.
+        """
+        specs = list(specs)
+        for spec in specs:
+            if 'name' not in spec:
+                raise ValueError('project spec %r has no name' % (spec,))
+
+        def ensure(spec):
+            try:
+                meta = self._projectMeta(**spec)
+                return (spec['name'], self._ensureProjectMeta(spec['name'], meta))
+            except Exception as e:
+                return (spec['name'], e)
+
+        with transport.priority(transport.BULK, override=False):
+            return dict(parallel_map(ensure, specs, workers))
 
     def projectAttributeExists(self, project, attribute):
         u = core.makeurl(self.apiurl, ['source',
@@ -1463,7 +2395,7 @@ class BuildService():
             action.tgt_package = None
 
         try:
-            return core.server_diff(self.apiurl, action.tgt_project,
+            return self.serverDiff(action.tgt_project,
                     action.tgt_package, None, action.src_project,
                     action.src_package, action.src_rev,
                     unified=False, missingok=True)
@@ -1603,6 +2535,68 @@ class BuildService():
         u = core.makeurl(self.apiurl, ['source', project, pkg, quote(filename)])
         return core.http_PUT(u, file=filepath)
 
+    def commitFiles(self, project, pkg, local_dir, message, delete_missing=True, workers=4):
+        """
+        commitFiles(project, pkg, local_dir, message, delete_missing=True, workers=4) -> str
+
+        Make the sources of package pkg match the files in local_dir with a
+        single commit. Only files whose md5 differs from the server copy are
+        uploaded, 'workers' at a time. Files that only exist on the server
+        are removed unless delete_missing is False.
+
+        Returns the revision of the package after the commit, raises
+        RuntimeError if the server refused the commit
+        """
+        local = {}
+        for name in sorted(os.listdir(local_dir)):
+            path = os.path.join(local_dir, name)
+            if os.path.isfile(path):
+                md5 = hashlib.md5()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(core.BUFSIZE), ''):
+                        md5.update(chunk)
+                local[name] = md5.hexdigest()
+
+        root = ElementTree.fromstring(''.join(core.show_files_meta(self.apiurl, project, pkg)))
+        remote = dict((entry.get('name'), entry.get('md5')) for entry in root.findall('entry'))
+
+        filelist = dict(local)
+        if not delete_missing:
+            for (name, md5) in remote.items():
+                filelist.setdefault(name, md5)
+        if filelist == remote:
+            return root.get('rev')
+
+        def upload(name):
+            # rev=repository stores the file without creating a revision
+            u = core.makeurl(self.apiurl, ['source', project, pkg, quote(name)],
+                             query={'rev': 'repository'})
+            core.http_PUT(u, file=os.path.join(local_dir, name))
+
+        def upload_all(names):
+            # a large commit must not crowd out interactive requests
+            with transport.priority(transport.BULK, override=False):
+                parallel_map(upload, names, workers)
+
+        upload_all([name for name in local if local[name] != remote.get(name)])
+
+        directory = ElementTree.Element('directory')
+        for name in sorted(filelist):
+            ElementTree.SubElement(directory, 'entry', name=name, md5=filelist[name])
+        u = core.makeurl(self.apiurl, ['source', project, pkg],
+                         query={'cmd': 'commitfilelist', 'user': self.getUserName(),
+                                'comment': message})
+        result = ElementTree.parse(core.http_POST(u, data=ElementTree.tostring(directory))).getroot()
+        if result.get('error') == 'missing':
+            # the server lost some blobs it had before, send them as well
+            upload_all([entry.get('name') for entry in result.findall('entry')
+                        if entry.get('name') in local])
+            result = ElementTree.parse(core.http_POST(u, data=ElementTree.tostring(directory))).getroot()
+        if result.get('error'):
+            raise RuntimeError("Commit of %s/%s failed: %s"
+                               % (project, pkg, result.get('error')))
+        return result.get('rev')
+
     def getCreatePackage(self, dst_project, dst_package):
         # Check whether the dst pac is a new one
         pkg = core.meta_exists(metatype = 'pkg',
@@ -1618,6 +2612,114 @@ class BuildService():
         return core.http_PUT(u, data=service)
 
 
+class BuildServicePool(object):
+    """
+    BuildServicePool(apiurls=None, oscrc=None, timeout=60, **kwargs)
+
+    Holds a BuildService for each of the given API servers, all servers
+    configured in oscrc by default, and runs calls on all of them at once.
+    Further keyword arguments are passed to every BuildService.
+
+    A server that does not answer within 'timeout' seconds is left out of the
+    results. The failures of the last call are kept in the 'errors' dict.
+    """
+    def __init__(self, apiurls=None, oscrc=None, timeout=60, **kwargs):
+        if not apiurls:
+            apiurls = BuildService(oscrc=oscrc, **kwargs).getAPIServerList()
+        self.timeout = timeout
+        self.services = {}
+        for apiurl in apiurls:
+            self.services[apiurl] = BuildService(apiurl, oscrc, **kwargs)
+        self.errors = {}
+
+    def fanout(self, name, *args, **kwargs):
+        """
+        fanout(name, *args, **kwargs) -> (dict, dict)
+
+        Call the BuildService method 'name' on every server concurrently.
+        Returns a dict of results and a dict of exceptions, both keyed by
+        apiurl. An optional 'timeout' keyword overrides the pool timeout.
+
+        Threads can't be killed, the call of a server which did not answer
+        in time keeps running in the background until its current request
+        fails with the deadline, at most 'timeout' seconds later.
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        outcome = {}
+
+        def call(apiurl, bs):
+            try:
+                with transport.deadline(timeout), transport.timeout(timeout):
+                    outcome[apiurl] = (getattr(bs, name)(*args, **kwargs), None)
+            except Exception as e:
+                outcome[apiurl] = (None, e)
+
+        threads = []
+        for (apiurl, bs) in self.services.items():
+            t = threading.Thread(target=transport.carry(call), args=(apiurl, bs))
+            # a hanging server must not keep the process alive
+            t.daemon = True
+            t.start()
+            threads.append((apiurl, t))
+
+        results = {}
+        errors = {}
+        deadline = time.time() + timeout
+        for (apiurl, t) in threads:
+            t.join(max(0, deadline - time.time()))
+            if t.is_alive():
+                # late answers may still come in, don't let them show up
+                errors[apiurl] = socket.timeout('%s did not answer within %s seconds'
+                                                % (apiurl, timeout))
+            elif outcome[apiurl][1] is not None:
+                errors[apiurl] = outcome[apiurl][1]
+            else:
+                results[apiurl] = outcome[apiurl][0]
+        self.errors = errors
+        return (results, errors)
+
+    def getProjectList(self):
+        """
+        getProjectList() -> list
+
+        Get list of (apiurl, project) pairs of all servers
+        """
+        (results, errors) = self.fanout('getProjectList')
+        return [(apiurl, project) for apiurl in sorted(results)
+                for project in results[apiurl]]
+
+    def getWorkerStatus(self):
+        """
+        getWorkerStatus() -> list of dicts
+
+        Get worker status of all servers, see BuildService.getWorkerStatus().
+        Each dict additionally contains the key 'apiurl'
+        """
+        (results, errors) = self.fanout('getWorkerStatus')
+        workers = []
+        for apiurl in sorted(results):
+            for worker in results[apiurl]:
+                worker['apiurl'] = apiurl
+                workers.append(worker)
+        return workers
+
+    def getSubmitRequests(self, *args, **kwargs):
+        """
+        getSubmitRequests(req_state=None, start_time=None, end_time=None, projects=None) -> list of dicts
+
+        Get submit requests of all servers, see
+        BuildService.getSubmitRequests(). Each dict additionally contains the
+        key 'apiurl'
+        """
+        (results, errors) = self.fanout('getSubmitRequests', *args, **kwargs)
+        requests = []
+        for apiurl in sorted(results):
+            for request in results[apiurl]:
+                request['apiurl'] = apiurl
+                requests.append(request)
+        return requests
+
+
 class ProjectFlags(object):
     """
     ProjectFlags(bs, project)
@@ -0,0 +1,278 @@
+#
+# cache.py - Persistent cache for immutable OBS objects
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class ObjectCache(object):
+    """
+    ObjectCache(path, max_size=1024*1024*1024)
+
+    On-disk cache for objects that never change once they exist, like
+    sources at a given srcmd5 or binaries with a given checksum.
+
+    The index is a SQLite database and the objects are plain files in a blob
+    directory below path. Writes go to a temporary file which is renamed into
+    place before it is indexed, so several processes can share one cache.
+    When the total size grows over max_size the least recently used objects
+    are evicted.
+    """
+    def __init__(self, path, max_size=1024*1024*1024):
+        self.path = path
+        self.max_size = max_size
+        self.blobdir = os.path.join(path, 'blobs')
+        if not os.path.isdir(self.blobdir):
+            try:
+                os.makedirs(self.blobdir)
+            except OSError:
+                if not os.path.isdir(self.blobdir):
+                    raise
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS objects ("
+                   "key TEXT PRIMARY KEY, blob TEXT, size INTEGER, atime REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS objects_atime ON objects (atime)")
+
+    def _db(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                                 timeout=60, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def _lookup(self, key):
+        # the caller counts the hit once the blob was read
+        row = self._db().execute("SELECT blob FROM objects WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is not None:
+            blob = os.path.join(self.blobdir, row[0])
+            if os.path.exists(blob):
+                self._db().execute("UPDATE objects SET atime = ? WHERE key = ?",
+                                   (time.time(), key))
+                return blob
+            # evicted by somebody else
+            self._db().execute("DELETE FROM objects WHERE key = ?", (key,))
+        self._count('misses')
+        return None
+
+    def get(self, key):
+        """
+        get(key) -> str or None
+
+        Return the cached object for key, None if it is not cached
+        """
+        blob = self._lookup(key)
+        if blob is None:
+            return None
+        try:
+            with open(blob, 'rb') as f:
+                data = f.read()
+        except IOError:
+            # evicted meanwhile
+            self._count('misses')
+            return None
+        self._count('hits')
+        return data
+
+    def getFile(self, key, path):
+        """
+        getFile(key, path) -> Bool
+
+        Copy the cached object for key to path. Returns False if it is not
+        cached. An existing file at path is replaced, not written to, so
+        files hard linked to it are left alone.
+        """
+        blob = self._lookup(key)
+        if blob is None:
+            return False
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp.', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                try:
+                    with open(blob, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                except IOError:
+                    # evicted meanwhile
+                    self._count('misses')
+                    return False
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, path)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+        self._count('hits')
+        return True
+
+    def _store(self, key, write):
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp.', dir=self.blobdir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            size = os.path.getsize(tmpname)
+            blobname = os.path.basename(tmpname)[len('.tmp.'):]
+            os.rename(tmpname, os.path.join(self.blobdir, blobname))
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+        stale = []
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT blob FROM objects WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                stale.append(row[0])
+            db.execute("INSERT OR REPLACE INTO objects (key, blob, size, atime) "
+                       "VALUES (?, ?, ?, ?)", (key, blobname, size, time.time()))
+            stale.extend(self._evict(db))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            os.unlink(os.path.join(self.blobdir, blobname))
+            raise
+        for name in stale:
+            try:
+                os.unlink(os.path.join(self.blobdir, name))
+            except OSError:
+                pass
+        self._count('stores')
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        victims = []
+        if total <= self.max_size:
+            return victims
+        for (key, blob, size) in db.execute(
+                "SELECT key, blob, size FROM objects ORDER BY atime").fetchall():
+            if total <= self.max_size:
+                break
+            db.execute("DELETE FROM objects WHERE key = ?", (key,))
+            victims.append(blob)
+            total -= size
+            self._count('evictions')
+        return victims
+
+    def put(self, key, data):
+        """
+        put(key, data)
+
+        Store the object data under key
+        """
+        self._store(key, lambda f: f.write(data))
+
+    def putFile(self, key, path):
+        """
+        putFile(key, path)
+
+        Store the contents of the file at path under key
+        """
+        def write(f):
+            with open(path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        self._store(key, write)
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        Return hit/miss/store/eviction counters of this process together with
+        the number of objects and the total size of the cache
+        """
+        (count, size) = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'stores': self.stores,
+                    'evictions': self.evictions,
+                    'objects': count,
+                    'size': size}
+
+
+class MemoryCache(object):
+    """
+    MemoryCache(max_size=16*1024*1024, store=None)
+
+    Bounded in-memory LRU cache of strings, for objects which are cheap to
+    keep but expensive to produce, like server side diffs. 'store' is an
+    optional ObjectCache used as a second, persistent tier.
+    """
+    def __init__(self, max_size=16*1024*1024, store=None):
+        self.max_size = max_size
+        self.store = store
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        get(key) -> str or None
+
+        Return the cached object for key, None if it is not cached
+        """
+        with self._lock:
+            data = self._items.pop(key, None)
+            if data is not None:
+                self._items[key] = data
+                return data
+        if self.store is not None:
+            data = self.store.get(key)
+            if data is not None:
+                self._remember(key, data)
+        return data
+
+    def _remember(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                (victim, old) = self._items.popitem(last=False)
+                self.size -= len(old)
+
+    def put(self, key, data):
+        """
+        put(key, data)
+
+        Store the object data under key
+        """
+        self._remember(key, data)
+        if self.store is not None:
+            self.store.put(key, data)
@@ -0,0 +1,235 @@
+#
+# history.py - Incremental cache of OBS commit and build history
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import threading
+import xml.etree.cElementTree as ElementTree
+from collections import OrderedDict
+from osc import core
+
+import transport
+
+
+@transport.bound
+class HistoryStore(object):
+    """
+    HistoryStore(apiurl, window=16, max_keys=1000, session=None)
+
+    Caches parsed commit history (source _history) and build history
+    (build _history) entries. Entries that have been seen once never change,
+    so later lookups only ask the server for the newest 'window' entries and
+    widen the window until they overlap with what is already cached.
+
+    The histories of at most 'max_keys' packages, and of as many package
+    targets, are kept, the least recently used ones are dropped.
+
+    Requests are sent with the transport.Session 'session' if given.
+    """
+    def __init__(self, apiurl, window=16, max_keys=1000, session=None):
+        self.apiurl = apiurl
+        self.session = session
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # (project, package) -> {rev: (rev, srcmd5, version, time, user, comment)}
+        self._commits = OrderedDict()
+        # (project, package) pairs whose whole history is in self._commits
+        self._complete = set()
+        # (project, package, target) -> [(time, srcmd5, rev, versrel, bcnt), ...]
+        self._builds = OrderedDict()
+
+    def _keep(self, store, key, value):
+        # store value as the most recently used entry, called with the lock held
+        store.pop(key, None)
+        store[key] = value
+        while len(store) > self.max_keys:
+            (victim, old) = store.popitem(last=False)
+            self._complete.discard(victim)
+
+    def _iterentries(self, url, tag, parse):
+        f = core.http_GET(url)
+        for event, node in ElementTree.iterparse(f):
+            if node.tag == tag:
+                yield parse(node)
+                node.clear()
+
+    @staticmethod
+    def _parse_revision(node):
+        try:
+            comment = node.find('comment').text
+        except AttributeError:
+            comment = '<no message>'
+        return (int(node.get('rev')),
+                node.find('srcmd5').text,
+                node.find('version').text,
+                int(node.find('time').text),
+                node.find('user').text,
+                comment)
+
+    @staticmethod
+    def _parse_build(node):
+        return (int(node.get('time')),
+                node.get('srcmd5'),
+                int(node.get('rev')),
+                node.get('versrel'),
+                int(node.get('bcnt')))
+
+    def _fetch_commits(self, project, package, query=None):
+        u = core.makeurl(self.apiurl, ['source', project, package, '_history'],
+                         query=query or {})
+        return list(self._iterentries(u, 'revision', self._parse_revision))
+
+    def _fetch_builds(self, project, package, target, query=None):
+        (repo, arch) = target.split('/')
+        u = core.makeurl(self.apiurl, ['build', project, repo, arch, package, '_history'],
+                         query=query or {})
+        return list(self._iterentries(u, 'entry', self._parse_build))
+
+    @staticmethod
+    def _recreated(known, entries):
+        # A recreated package restarts its revision numbering, the entries
+        # fetched then disagree with the cached ones of the same revision
+        # or the newest revision is older than cached ones
+        if entries and known and max(e[0] for e in entries) < max(known):
+            return True
+        for entry in entries:
+            if entry[0] in known and known[entry[0]][1] != entry[1]:
+                return True
+        return False
+
+    def _forget_if_recreated(self, project, package, known, entries):
+        # drop the cached commits of a recreated package, returns whether
+        # it was recreated
+        if not self._recreated(known, entries):
+            return False
+        with self._lock:
+            self._commits.pop((project, package), None)
+            self._complete.discard((project, package))
+        return True
+
+    def commit(self, project, package, revision):
+        """
+        commit(project, package, revision) -> tuple or None
+
+        Return the commit log entry of a single revision, asking the server
+        only for that revision if it is not cached yet. A cached entry is
+        only returned after the newest revision on the server confirmed
+        that the package was not recreated meanwhile.
+        """
+        key = (project, package)
+        revision = int(revision)
+        with self._lock:
+            known = dict(self._commits.get(key, {}))
+        if known.get(revision) is not None:
+            newest = self._fetch_commits(project, package, {'limit': 1})
+            if not self._forget_if_recreated(project, package, known, newest):
+                with self._lock:
+                    current = self._commits.get(key, known)
+                    for entry in newest:
+                        current[entry[0]] = entry
+                    self._keep(self._commits, key, current)
+                return known[revision]
+
+        entries = self._fetch_commits(project, package, {'rev': revision})
+        with self._lock:
+            known = self._commits.get(key, {})
+            for entry in entries:
+                known[entry[0]] = entry
+            self._keep(self._commits, key, known)
+            return known.get(revision)
+
+    def commits(self, project, package):
+        """
+        commits(project, package) -> list
+
+        Return all commit log entries of a package, oldest first, fetching
+        only the revisions newer than the cached ones
+        """
+        key = (project, package)
+        with self._lock:
+            complete = key in self._complete
+            known = dict(self._commits.get(key, {}))
+
+        if not complete or not known:
+            entries = self._fetch_commits(project, package)
+            known = {}
+        else:
+            top = max(known)
+            limit = self.window
+            while True:
+                entries = self._fetch_commits(project, package, {'limit': limit})
+                if len(entries) < limit or min(e[0] for e in entries) <= top:
+                    break
+                limit *= 4
+            # the cached entries of a recreated package are worthless
+            if self._recreated(known, entries):
+                entries = self._fetch_commits(project, package)
+                known = {}
+
+        for entry in entries:
+            known[entry[0]] = entry
+        with self._lock:
+            self._keep(self._commits, key, known)
+            self._complete.add(key)
+        return [known[rev] for rev in sorted(known)]
+
+    def builds(self, project, package, target):
+        """
+        builds(project, package, target) -> list
+
+        Return all build history entries of a package for target, oldest
+        first, fetching only the entries newer than the cached ones
+        """
+        key = (project, package, target)
+        with self._lock:
+            known = list(self._builds.get(key, []))
+
+        if not known:
+            known = self._fetch_builds(project, package, target)
+        else:
+            last = known[-1]
+            limit = self.window
+            while True:
+                entries = self._fetch_builds(project, package, target, {'limit': limit})
+                if last in entries:
+                    known.extend(entries[entries.index(last) + 1:])
+                    break
+                if len(entries) < limit:
+                    # the cached history is gone from the server
+                    known = entries
+                    break
+                limit *= 4
+
+        with self._lock:
+            self._keep(self._builds, key, known)
+        return list(known)
+
+    def forget(self, project=None, package=None):
+        """
+        forget(project=None, package=None)
+
+        Drop cached entries, of a single package, a whole project or everything
+        """
+        def match(key):
+            return ((project is None or key[0] == project) and
+                    (package is None or key[1] == package))
+
+        with self._lock:
+            for store in (self._commits, self._builds):
+                for key in [k for k in store if match(k)]:
+                    del store[key]
+            self._complete = set(k for k in self._complete if not match(k))
@@ -0,0 +1,595 @@
+#
+# index.py - In-memory indexes over OBS data
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import bisect
+import fnmatch
+import threading
+import time
+import xml.etree.cElementTree as ElementTree
+from urllib import quote_plus
+from urllib2 import HTTPError
+from osc import core
+
+import transport
+
+
+@transport.bound
+class ProjectCatalog(object):
+    """
+    ProjectCatalog(apiurl, ttl=300, session=None)
+
+    Cached list of the project names on a server, indexed for existence
+    checks and prefix queries.
+
+    The list is reloaded when it is older than 'ttl' seconds, using a
+    conditional request so an unchanged list is not transferred again. Only
+    the very first load blocks, later reloads happen in the background while
+    callers keep getting the previous list.
+
+    Requests are sent with the transport.Session 'session' if given.
+    """
+    def __init__(self, apiurl, ttl=300, session=None):
+        self.apiurl = apiurl
+        self.session = session
+        self.ttl = ttl
+        self._names = frozenset()
+        self._sorted = []
+        self._stamp = None
+        self._validators = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self):
+        """
+        refresh()
+
+        Reload the project list now
+        """
+        headers = {}
+        if 'etag' in self._validators:
+            headers['If-None-Match'] = self._validators['etag']
+        if 'last-modified' in self._validators:
+            headers['If-Modified-Since'] = self._validators['last-modified']
+
+        u = core.makeurl(self.apiurl, ['source'])
+        try:
+            f = transport.http_request('GET', u, headers=headers)
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            with self._lock:
+                self._stamp = time.time()
+            return
+
+        names = []
+        for event, node in ElementTree.iterparse(f):
+            if node.tag == 'entry':
+                name = node.get('name')
+                if name != 'deleted':
+                    names.append(name)
+                node.clear()
+        validators = {}
+        for header in ('etag', 'last-modified'):
+            value = f.info().getheader(header)
+            if value:
+                validators[header] = value
+
+        names.sort()
+        with self._lock:
+            self._sorted = names
+            self._names = frozenset(names)
+            self._validators = validators
+            self._stamp = time.time()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _current(self):
+        if self._stamp is None:
+            # Concurrent first callers wait for a single load
+            with self._load_lock:
+                if self._stamp is None:
+                    self.refresh()
+        elif time.time() - self._stamp > self.ttl:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                t = threading.Thread(target=transport.carry(self._background_refresh))
+                t.daemon = True
+                t.start()
+        with self._lock:
+            return (self._names, self._sorted)
+
+    def exists(self, name):
+        """
+        exists(name) -> Bool
+
+        Tells whether project 'name' exists
+        """
+        (names, ordered) = self._current()
+        return name in names
+
+    def startswith(self, prefix):
+        """
+        startswith(prefix) -> list
+
+        Returns the sorted names of all projects starting with prefix
+        """
+        (names, ordered) = self._current()
+        result = []
+        for i in xrange(bisect.bisect_left(ordered, prefix), len(ordered)):
+            if not ordered[i].startswith(prefix):
+                break
+            result.append(ordered[i])
+        return result
+
+    def match(self, pattern):
+        """
+        match(pattern) -> list
+
+        Returns the sorted names of all projects matching a shell style
+        pattern like 'home:*' or 'Mer:Tools:*'
+        """
+        wildcard = min([i for i in (pattern.find(c) for c in '*?[') if i >= 0] or [len(pattern)])
+        if wildcard == len(pattern):
+            return [pattern] if self.exists(pattern) else []
+        candidates = self.startswith(pattern[:wildcard])
+        if pattern[wildcard:] == '*':
+            return candidates
+        return [name for name in candidates if fnmatch.fnmatchcase(name, pattern)]
+
+    def names(self):
+        """
+        names() -> list
+
+        Returns the sorted names of all projects
+        """
+        return list(self._current()[1])
+
+    def add(self, name):
+        """
+        add(name)
+
+        Record a project created through this process
+        """
+        with self._lock:
+            if self._stamp is not None and name not in self._names:
+                # readers may be iterating over the old list
+                ordered = list(self._sorted)
+                bisect.insort(ordered, name)
+                self._sorted = ordered
+                self._names = self._names | frozenset([name])
+
+    def discard(self, name):
+        """
+        discard(name)
+
+        Record a project deleted through this process
+        """
+        with self._lock:
+            if name in self._names:
+                self._sorted = [n for n in self._sorted if n != name]
+                self._names = self._names - frozenset([name])
+
+
+def search(apiurl, kind, xpath, tag):
+    """
+    search(apiurl, kind, xpath, tag) -> generator of Elements
+
+    Run an xpath search on /search/kind and yield the 'tag' elements of the
+    result one at a time. Each element is only valid until the next one is
+    yielded.
+    """
+    u = core.makeurl(apiurl, ['search', kind], ['match=%s' % quote_plus(xpath)])
+    for event, node in ElementTree.iterparse(core.http_GET(u)):
+        if node.tag == tag:
+            yield node
+            node.clear()
+
+
+def xpath_literal(value):
+    """
+    xpath_literal(value) -> str
+
+    Returns value quoted as an xpath string literal. XPath has no escapes,
+    values containing both kinds of quotes raise ValueError.
+    """
+    if "'" not in value:
+        return "'%s'" % value
+    if '"' not in value:
+        return '"%s"' % value
+    raise ValueError('%r can not be quoted in xpath' % (value,))
+
+
+def xpath_any(attribute, values, limit=3000):
+    """
+    xpath_any(attribute, values, limit=3000) -> generator of str
+
+    Yield xpath expressions matching elements whose attribute has one of the
+    values, split to keep each expression short enough for an URL
+    """
+    terms = []
+    size = 0
+    for value in values:
+        term = '%s=%s' % (attribute, xpath_literal(value))
+        if terms and size + len(term) > limit:
+            yield ' or '.join(terms)
+            terms = []
+            size = 0
+        terms.append(term)
+        size += len(term) + 4
+    if terms:
+        yield ' or '.join(terms)
+
+
+@transport.bound
+class PersonIndex(object):
+    """
+    PersonIndex(bs)
+
+    Index of the person and group roles of projects and packages on the
+    server of BuildService bs, queryable in both directions. Group roles are
+    expanded to the members of the group.
+
+    load() fetches the metas of all projects and packages having roles with
+    two searches, refresh(projects) reloads some projects and their
+    packages only.
+    """
+    def __init__(self, bs):
+        self.bs = bs
+        # requests are sent with the credentials of bs
+        self.session = bs.session
+        self._lock = threading.Lock()
+        # (project, package) -> [(kind, id, role)], package is None for projects
+        self._objects = {}
+        # group -> [userids]
+        self._groups = {}
+        # userid -> set((project, package, role, group))
+        self._by_person = {}
+        # (project, package) -> {role: set(userids)}
+        self._by_object = {}
+
+    def _fetch_members(self, objects, groups=(), workers=8):
+        # Fetch the given groups and all groups of objects not known yet
+        groups = set(groups)
+        with self._lock:
+            for roles in objects.values():
+                groups.update(name for (kind, name, role) in roles
+                              if kind == 'group' and name not in self._groups)
+        return dict(transport.parallel_map(
+            lambda group: (group, self.bs.getGroupUsers(group)), sorted(groups), workers))
+
+    @staticmethod
+    def _roles(node):
+        roles = []
+        for person in node.findall('person'):
+            roles.append(('person', person.get('userid'), person.get('role')))
+        for group in node.findall('group'):
+            roles.append(('group', group.get('groupid'), group.get('role')))
+        return roles
+
+    def _fetch(self, projects):
+        objects = {}
+        if projects is None:
+            prj_queries = pkg_queries = ['person or group']
+        else:
+            prj_queries = ['(%s) and (person or group)' % x
+                           for x in xpath_any('@name', projects)]
+            pkg_queries = ['(%s) and (person or group)' % x
+                           for x in xpath_any('@project', projects)]
+        for xpath in prj_queries:
+            for node in search(self.bs.apiurl, 'project', xpath, 'project'):
+                objects[(node.get('name'), None)] = self._roles(node)
+        for xpath in pkg_queries:
+            for node in search(self.bs.apiurl, 'package', xpath, 'package'):
+                objects[(node.get('project'), node.get('name'))] = self._roles(node)
+        return objects
+
+    def _link(self, obj, roles):
+        self._objects[obj] = roles
+        by_role = self._by_object.setdefault(obj, {})
+        for (kind, name, role) in roles:
+            if kind == 'person':
+                members = [(name, None)]
+            else:
+                members = [(userid, name) for userid in self._groups.get(name, [])]
+            for (userid, group) in members:
+                by_role.setdefault(role, set()).add(userid)
+                self._by_person.setdefault(userid, set()).add(obj + (role, group))
+
+    def _unlink(self, obj):
+        for userids in self._by_object.pop(obj, {}).values():
+            for userid in userids:
+                entries = self._by_person.get(userid, set())
+                for entry in [e for e in entries if e[:2] == obj]:
+                    entries.discard(entry)
+                if not entries:
+                    self._by_person.pop(userid, None)
+        self._objects.pop(obj, None)
+
+    def load(self):
+        """
+        load()
+
+        (Re)build the whole index
+        """
+        objects = self._fetch(None)
+        with self._lock:
+            self._groups = {}
+        members = self._fetch_members(objects)
+        with self._lock:
+            self._groups = members
+            self._objects = {}
+            self._by_person = {}
+            self._by_object = {}
+            for (obj, roles) in objects.items():
+                self._link(obj, roles)
+
+    def refresh(self, projects, groups=()):
+        """
+        refresh(projects, groups=())
+
+        Reload the roles of the given projects and their packages, and the
+        members of the given groups
+        """
+        objects = self._fetch(projects)
+        members = self._fetch_members(objects, groups)
+        with self._lock:
+            self._groups.update(members)
+            projects = set(projects)
+            stale = [obj for obj in self._objects
+                     if obj[0] in projects or
+                     any(kind == 'group' and name in members
+                         for (kind, name, role) in self._objects[obj])]
+            for obj in stale:
+                roles = self._objects[obj]
+                self._unlink(obj)
+                if obj[0] not in projects:
+                    objects[obj] = roles
+            for (obj, roles) in objects.items():
+                self._unlink(obj)
+                self._link(obj, roles)
+
+    def roles(self, userid, role=None):
+        """
+        roles(userid, role=None) -> list
+
+        Returns the roles of userid as a sorted list of (project, package,
+        role, group) tuples. package is None for project roles, group is the
+        group the role comes from, None for direct roles
+        """
+        with self._lock:
+            entries = self._by_person.get(userid, set())
+            return sorted(e for e in entries if role is None or e[2] == role)
+
+    def people(self, project, package=None, role=None):
+        """
+        people(project, package=None, role=None) -> set
+
+        Returns the userids with a role, or the given role, in a project or
+        package, directly or through a group
+        """
+        with self._lock:
+            by_role = self._by_object.get((project, package), {})
+            if role is not None:
+                return set(by_role.get(role, set()))
+            return set().union(*by_role.values())
+
+
+@transport.bound
+class RepositoryGraph(object):
+    """
+    RepositoryGraph(bs)
+
+    Graph of the repository paths of all projects on the server of
+    BuildService bs. Repositories are named 'project/repository' and each
+    one points to the repositories in its <path> elements, that is to what
+    it builds against.
+
+    load() fetches all project metas with one search, refresh(projects)
+    reloads some projects only. The queries only look at the loaded graph.
+    """
+    def __init__(self, bs):
+        self.bs = bs
+        # requests are sent with the credentials of bs
+        self.session = bs.session
+        self._lock = threading.Lock()
+        # repository -> [repositories it builds against], in path order
+        self._paths = {}
+        # repository -> set(repositories building against it)
+        self._consumers = {}
+        # repository -> [archs]
+        self._archs = {}
+
+    def _fetch(self, projects):
+        repos = {}
+        if projects is None:
+            queries = ['repository']
+        else:
+            queries = ['(%s) and repository' % x for x in xpath_any('@name', projects)]
+        for xpath in queries:
+            for node in search(self.bs.apiurl, 'project', xpath, 'project'):
+                project = node.get('name')
+                for repo in node.findall('repository'):
+                    name = '%s/%s' % (project, repo.get('name'))
+                    paths = ['%s/%s' % (path.get('project'), path.get('repository'))
+                             for path in repo.findall('path')]
+                    archs = [arch.text for arch in repo.findall('arch')]
+                    repos[name] = (paths, archs)
+        return repos
+
+    def _build(self, paths):
+        consumers = {}
+        for (repo, targets) in paths.items():
+            for target in targets:
+                consumers.setdefault(target, set()).add(repo)
+        return consumers
+
+    def load(self):
+        """
+        load()
+
+        (Re)build the whole graph
+        """
+        repos = self._fetch(None)
+        paths = dict((repo, p) for (repo, (p, a)) in repos.items())
+        archs = dict((repo, a) for (repo, (p, a)) in repos.items())
+        consumers = self._build(paths)
+        with self._lock:
+            (self._paths, self._archs, self._consumers) = (paths, archs, consumers)
+
+    def refresh(self, projects):
+        """
+        refresh(projects)
+
+        Reload the repositories of the given projects
+        """
+        repos = self._fetch(projects)
+        projects = set(projects)
+        with self._lock:
+            paths = dict((repo, p) for (repo, p) in self._paths.items()
+                         if repo.split('/', 1)[0] not in projects)
+            archs = dict((repo, a) for (repo, a) in self._archs.items()
+                         if repo.split('/', 1)[0] not in projects)
+        for (repo, (p, a)) in repos.items():
+            paths[repo] = p
+            archs[repo] = a
+        consumers = self._build(paths)
+        with self._lock:
+            (self._paths, self._archs, self._consumers) = (paths, archs, consumers)
+
+    def repositories(self, project=None):
+        """
+        repositories(project=None) -> list
+
+        Returns the sorted names of the repositories of project, or of all
+        loaded repositories
+        """
+        with self._lock:
+            repos = self._paths.keys()
+        if project is not None:
+            repos = [r for r in repos if r.split('/', 1)[0] == project]
+        return sorted(repos)
+
+    def paths(self, repository):
+        """
+        paths(repository) -> list
+
+        Returns the repositories repository builds against directly, in path
+        order
+        """
+        with self._lock:
+            return list(self._paths.get(repository, []))
+
+    def archs(self, repository):
+        """
+        archs(repository) -> list
+
+        Returns the architectures of repository
+        """
+        with self._lock:
+            return list(self._archs.get(repository, []))
+
+    def _walk(self, start, edges):
+        seen = set()
+        todo = [start]
+        while todo:
+            for repo in edges(todo.pop()):
+                if repo not in seen:
+                    seen.add(repo)
+                    todo.append(repo)
+        seen.discard(start)
+        return seen
+
+    def dependencies(self, repository, transitive=True):
+        """
+        dependencies(repository, transitive=True) -> set
+
+        Returns the repositories repository builds against, directly or
+        through other repositories
+        """
+        with self._lock:
+            paths = self._paths
+        if not transitive:
+            return set(paths.get(repository, []))
+        return self._walk(repository, lambda repo: paths.get(repo, []))
+
+    def consumers(self, repository, transitive=True):
+        """
+        consumers(repository, transitive=True) -> set
+
+        Returns the repositories building against repository, directly or
+        through other repositories
+        """
+        with self._lock:
+            consumers = self._consumers
+        if not transitive:
+            return set(consumers.get(repository, set()))
+        return self._walk(repository, lambda repo: consumers.get(repo, set()))
+
+    def consumerProjects(self, repository):
+        """
+        consumerProjects(repository) -> list
+
+        Returns the sorted names of the projects with a repository building
+        against repository, directly or transitively
+        """
+        return sorted(set(repo.split('/', 1)[0] for repo in self.consumers(repository)))
+
+    def layers(self, repositories=None):
+        """
+        layers(repositories=None) -> (list, list)
+
+        Orders repositories, all loaded ones by default, so that every one
+        comes after the repositories it builds against. Returns (layers,
+        cyclic): layers is a list of sorted lists of repositories, each
+        building only against repositories in earlier layers or outside the
+        given ones, cyclic the sorted repositories which can't be ordered:
+        those in a cycle and those building against a cycle, directly or
+        through other repositories
+        """
+        with self._lock:
+            paths = self._paths
+            consumers = self._consumers
+        if repositories is None:
+            repositories = paths.keys()
+        repositories = set(repositories)
+
+        pending = {}
+        for repo in repositories:
+            pending[repo] = len(set(paths.get(repo, [])) & repositories)
+        layer = sorted(repo for (repo, count) in pending.items() if count == 0)
+        layers = []
+        while layer:
+            layers.append(layer)
+            following = []
+            for repo in layer:
+                del pending[repo]
+                for consumer in consumers.get(repo, set()):
+                    if consumer in pending:
+                        pending[consumer] -= 1
+                        if pending[consumer] == 0:
+                            following.append(consumer)
+            layer = sorted(following)
+        return (layers, sorted(pending))
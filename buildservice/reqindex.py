@@ -0,0 +1,244 @@
+#
+# reqindex.py - Local index of OBS requests
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import sqlite3
+import threading
+import xml.etree.cElementTree as ElementTree
+from urllib import quote_plus
+from osc import core
+
+import transport
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY, creator TEXT, state TEXT, state_who TEXT,
+    state_when TEXT, description TEXT);
+CREATE INDEX IF NOT EXISTS requests_state ON requests (state, state_when);
+CREATE INDEX IF NOT EXISTS requests_when ON requests (state_when);
+CREATE TABLE IF NOT EXISTS actions (
+    request_id INTEGER, seq INTEGER, type TEXT,
+    src_project TEXT, src_package TEXT, src_rev TEXT,
+    tgt_project TEXT, tgt_package TEXT);
+CREATE INDEX IF NOT EXISTS actions_request ON actions (request_id);
+CREATE INDEX IF NOT EXISTS actions_tgt ON actions (tgt_project, tgt_package);
+CREATE INDEX IF NOT EXISTS actions_src ON actions (src_project, src_package);
+CREATE TABLE IF NOT EXISTS reviews (
+    request_id INTEGER, seq INTEGER, state TEXT, by_user TEXT, by_group TEXT,
+    by_project TEXT, by_package TEXT, who TEXT, "when" TEXT, comment TEXT);
+CREATE INDEX IF NOT EXISTS reviews_request ON reviews (request_id);
+CREATE INDEX IF NOT EXISTS reviews_user ON reviews (by_user);
+CREATE INDEX IF NOT EXISTS reviews_group ON reviews (by_group);
+CREATE TABLE IF NOT EXISTS history (
+    request_id INTEGER, seq INTEGER, name TEXT, who TEXT, "when" TEXT,
+    comment TEXT);
+CREATE INDEX IF NOT EXISTS history_request ON history (request_id);
+CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _text(node, tag):
+    child = node.find(tag)
+    if child is None:
+        return None
+    return child.text
+
+
+@transport.bound
+class RequestIndex(object):
+    """
+    RequestIndex(bs, path, match=None)
+
+    Local SQLite copy of the requests on the server of BuildService bs,
+    stored in the database file 'path'. 'match' is an optional xpath
+    expression limiting the requests that are indexed, like
+    "action/target/@project='Mer:Core'".
+
+    sync() fetches only the requests that are new or changed since the last
+    sync, the query methods only look at the local copy.
+    """
+    def __init__(self, bs, path, match=None):
+        self.bs = bs
+        # requests are sent with the credentials of bs
+        self.session = bs.session
+        self.path = path
+        self.match = match
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            self._local.db = db
+        return db
+
+    def _get_sync(self, key, default):
+        row = self._db().execute("SELECT value FROM sync WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def sync(self):
+        """
+        sync() -> int
+
+        Fetch requests created or changed since the last sync. Returns the
+        number of requests stored
+        """
+        last_id = int(self._get_sync('last_id', 0))
+        last_when = self._get_sync('last_when', '')
+
+        xpath = ''
+        if last_id or last_when:
+            xpath = ("@id>%d or state/@when>='%s' or review/@when>='%s'"
+                     % (last_id, last_when, last_when))
+        if self.match:
+            xpath = core.xpath_join(xpath, self.match, op='and',
+                                    nexpr_parentheses=True)
+        query = ['withfullhistory=1']
+        if xpath:
+            query.append('match=%s' % quote_plus(xpath))
+        u = core.makeurl(self.bs.apiurl, ['search', 'request'], query)
+
+        db = self._db()
+        count = 0
+        with db:
+            for event, node in ElementTree.iterparse(core.http_GET(u)):
+                if node.tag != 'request':
+                    continue
+                self._store(db, node)
+                last_id = max(last_id, int(node.get('id')))
+                for tag in ('state', 'review', 'history'):
+                    for child in node.findall(tag):
+                        last_when = max(last_when, child.get('when') or '')
+                node.clear()
+                count += 1
+            db.execute("INSERT OR REPLACE INTO sync VALUES ('last_id', ?)", (str(last_id),))
+            db.execute("INSERT OR REPLACE INTO sync VALUES ('last_when', ?)", (last_when,))
+        return count
+
+    def _store(self, db, node):
+        reqid = int(node.get('id'))
+        for table in ('actions', 'reviews', 'history'):
+            db.execute("DELETE FROM %s WHERE request_id = ?" % table, (reqid,))
+
+        state = node.find('state')
+        db.execute("INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?, ?)",
+                   (reqid, node.get('creator'), state.get('name'), state.get('who'),
+                    state.get('when'), _text(node, 'description')))
+
+        for (seq, action) in enumerate(node.findall('action')):
+            source = action.find('source')
+            target = action.find('target')
+            if source is None:
+                source = {}
+            if target is None:
+                target = {}
+            db.execute("INSERT INTO actions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (reqid, seq, action.get('type'),
+                        source.get('project'), source.get('package'), source.get('rev'),
+                        target.get('project'), target.get('package')))
+
+        for (seq, review) in enumerate(node.findall('review')):
+            db.execute("INSERT INTO reviews VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (reqid, seq, review.get('state'), review.get('by_user'),
+                        review.get('by_group'), review.get('by_project'),
+                        review.get('by_package'), review.get('who'),
+                        review.get('when'), _text(review, 'comment')))
+
+        for (seq, history) in enumerate(node.findall('history')):
+            # older servers name the state, newer ones describe the change
+            name = history.get('name') or _text(history, 'description')
+            db.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)",
+                       (reqid, seq, name, history.get('who'), history.get('when'),
+                        _text(history, 'comment')))
+
+    def query(self, project=None, package=None, state=None, reviewer=None,
+              review_state='new', action_type=None, since=None, until=None):
+        """
+        query(project=None, package=None, state=None, reviewer=None,
+              review_state='new', action_type=None, since=None, until=None) -> list
+
+        Returns the ids of the matching requests, newest first:
+
+        project/package: source or target of an action
+        state: request state name or list of names
+        reviewer: user, group or project with a review in review_state
+                  (any state if review_state is None)
+        action_type: type of an action, like 'submit'
+        since/until: bounds of the state change time, as in
+                     '2012-01-31T12:00:00'
+        """
+        where = []
+        args = []
+        if project or package or action_type:
+            sub = []
+            for (column, value) in (('project', project), ('package', package)):
+                if value:
+                    sub.append("(a.src_%s = ? OR a.tgt_%s = ?)" % (column, column))
+                    args += [value, value]
+            if action_type:
+                sub.append("a.type = ?")
+                args.append(action_type)
+            where.append("r.id IN (SELECT a.request_id FROM actions a WHERE %s)"
+                         % ' AND '.join(sub))
+        if reviewer:
+            sub = "(v.by_user = ? OR v.by_group = ? OR v.by_project = ?)"
+            args += [reviewer, reviewer, reviewer]
+            if review_state:
+                sub += " AND v.state = ?"
+                args.append(review_state)
+            where.append("r.id IN (SELECT v.request_id FROM reviews v WHERE %s)" % sub)
+        if state:
+            if isinstance(state, basestring):
+                state = [state]
+            where.append("r.state IN (%s)" % ', '.join('?' * len(state)))
+            args += list(state)
+        if since:
+            where.append("r.state_when >= ?")
+            args.append(since)
+        if until:
+            where.append("r.state_when < ?")
+            args.append(until)
+
+        sql = "SELECT r.id FROM requests r"
+        if where:
+            sql += " WHERE " + ' AND '.join(where)
+        sql += " ORDER BY r.id DESC"
+        return [row[0] for row in self._db().execute(sql, args)]
+
+    def get(self, reqid):
+        """
+        get(reqid) -> dict or None
+
+        Returns a request as a dict with the keys of the requests table and
+        lists of dicts under 'actions', 'reviews' and 'history'
+        """
+        db = self._db()
+        cursor = db.execute("SELECT * FROM requests WHERE id = ?", (int(reqid),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        request = dict(zip([c[0] for c in cursor.description], row))
+        for table in ('actions', 'reviews', 'history'):
+            cursor = db.execute("SELECT * FROM %s WHERE request_id = ? ORDER BY seq" % table,
+                                (int(reqid),))
+            columns = [c[0] for c in cursor.description]
+            request[table] = [dict(zip(columns, r)) for r in cursor]
+        return request
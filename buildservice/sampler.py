@@ -0,0 +1,345 @@
+#
+# sampler.py - Time series of OBS worker and queue usage
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import array
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+import xml.etree.cElementTree as ElementTree
+from osc import core
+
+import transport
+
+_header = struct.Struct('<8sQQQ')
+_magic = 'BSRING1\0'
+
+
+class RingBuffer(object):
+    """
+    RingBuffer(fields, capacity, path=None)
+
+    Fixed size buffer of the last 'capacity' records, each a tuple of
+    len(fields) floats. The first field must be a time stamp which grows
+    with every record, windows of records are found by bisecting it.
+
+    The records live in one flat array, or in the file at path mapped into
+    memory, in which case the buffer survives restarts.
+    """
+    def __init__(self, fields, capacity, path=None):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.path = path
+        self._record = struct.Struct('<%dd' % len(self.fields))
+        size = _header.size + capacity * self._record.size
+        self._lock = threading.Lock()
+        self._file = None
+        if path is None:
+            self._buf = array.array('d', [0.0]) * (size // 8 + 1)
+            self.count = 0
+            return
+
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        self._file = open(path, 'r+b' if not fresh else 'w+b')
+        if fresh:
+            self._file.truncate(size)
+        self._buf = mmap.mmap(self._file.fileno(), size)
+        (magic, nfields, capacity, count) = _header.unpack_from(self._buf, 0)
+        if magic != _magic or nfields != len(self.fields) or capacity != self.capacity:
+            count = 0
+        self.count = count
+        self._write_header()
+
+    def _write_header(self):
+        _header.pack_into(self._buf, 0, _magic, len(self.fields), self.capacity, self.count)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, values):
+        """
+        append(values)
+
+        Add a record, overwriting the oldest one when the buffer is full
+        """
+        with self._lock:
+            slot = self.count % self.capacity
+            self._record.pack_into(self._buf, _header.size + slot * self._record.size,
+                                   *values)
+            self.count += 1
+            self._write_header()
+
+    def _get(self, i):
+        # i-th oldest record
+        slot = (self.count - len(self) + i) % self.capacity
+        return self._record.unpack_from(self._buf, _header.size + slot * self._record.size)
+
+    def _bisect(self, stamp):
+        (lo, hi) = (0, len(self))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get(mid)[0] < stamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, since=None, until=None):
+        """
+        window(since=None, until=None) -> list
+
+        Returns the records with since <= time < until, oldest first
+        """
+        with self._lock:
+            start = 0 if since is None else self._bisect(since)
+            end = len(self) if until is None else self._bisect(until)
+            return [self._get(i) for i in xrange(start, end)]
+
+    def flush(self):
+        """
+        flush()
+
+        Write a mapped buffer back to its file
+        """
+        if self._file is not None:
+            with self._lock:
+                self._buf.flush()
+
+    def close(self):
+        """
+        close()
+
+        Write a mapped buffer back to its file and unmap it
+        """
+        if self._file is not None:
+            with self._lock:
+                self._buf.flush()
+                self._buf.close()
+                self._file.close()
+                self._file = None
+
+
+def percentiles(values, points):
+    """
+    percentiles(values, points) -> dict
+
+    Returns the nearest rank percentiles of values for each of points, None
+    for an empty list
+    """
+    values = sorted(values)
+    result = {}
+    for p in points:
+        if not values:
+            result[p] = None
+        else:
+            rank = int(round(p / 100.0 * (len(values) - 1)))
+            result[p] = values[rank]
+    return result
+
+
+@transport.bound
+class WorkerSampler(object):
+    """
+    WorkerSampler(bs, interval=60, capacity=10080, path=None)
+
+    Polls the _workerstatus of the server of BuildService bs every 'interval'
+    seconds in a background thread, see start() and stop(). Every poll
+    stores, per architecture, the number of busy and idle workers and of
+    waiting and blocked jobs. Jobs seen finishing between two polls store
+    their approximate duration. Workers are counted by their host
+    architecture, jobs by the scheduler architecture.
+
+    The last 'capacity' samples and job durations per architecture are kept
+    in RingBuffers, memory mapped to files in directory 'path' if given.
+    """
+    SAMPLE_FIELDS = ('time', 'busy', 'idle', 'waiting', 'blocked')
+    JOB_FIELDS = ('time', 'duration')
+
+    def __init__(self, bs, interval=60, capacity=10080, path=None):
+        self.bs = bs
+        # polls are sent with the credentials of bs
+        self.session = bs.session
+        self.interval = interval
+        self.capacity = capacity
+        self.path = path
+        self.errors = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._jobs = {}
+        # (workerid, starttime) -> hostarch of the jobs building at the last poll
+        self._running = {}
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = None
+        if path:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for name in glob.glob(os.path.join(path, '*.samples')):
+                self._ring(self._samples, os.path.basename(name)[:-len('.samples')])
+            for name in glob.glob(os.path.join(path, '*.jobs')):
+                self._ring(self._jobs, os.path.basename(name)[:-len('.jobs')])
+
+    def _ring(self, rings, arch):
+        with self._lock:
+            if arch not in rings:
+                if rings is self._samples:
+                    (fields, suffix) = (self.SAMPLE_FIELDS, 'samples')
+                else:
+                    (fields, suffix) = (self.JOB_FIELDS, 'jobs')
+                path = None
+                if self.path:
+                    path = os.path.join(self.path, '%s.%s' % (arch, suffix))
+                rings[arch] = RingBuffer(fields, self.capacity, path)
+            return rings[arch]
+
+    def sample(self):
+        """
+        sample()
+
+        Poll the server once and record the result
+        """
+        url = core.makeurl(self.bs.apiurl, ['build', '_workerstatus'])
+        with transport.priority(transport.BULK, override=False):
+            tree = ElementTree.parse(core.http_GET(url)).getroot()
+        now = time.time()
+
+        counts = {}
+        def count(arch, index):
+            counts.setdefault(arch, [0, 0, 0, 0])[index] += 1
+
+        running = {}
+        for worker in tree.findall('building'):
+            count(worker.get('hostarch'), 0)
+            running[(worker.get('workerid'), worker.get('starttime'))] = worker.get('hostarch')
+        for worker in tree.findall('idle'):
+            count(worker.get('hostarch'), 1)
+        for (tag, index) in (('waiting', 2), ('blocked', 3)):
+            for node in tree.findall(tag):
+                counts.setdefault(node.get('arch'), [0, 0, 0, 0])[index] += int(node.get('jobs'))
+
+        for (arch, values) in counts.items():
+            self._ring(self._samples, arch).append([now] + values)
+
+        if self._last is not None:
+            # the job ended somewhere between the two polls
+            end = (self._last + now) / 2
+            for (key, arch) in self._running.items():
+                if key not in running:
+                    duration = max(0.0, end - float(key[1]))
+                    self._ring(self._jobs, arch).append((end, duration))
+        self._running = running
+        self._last = now
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                # keep sampling through server hiccups
+                self.errors += 1
+                self.last_error = e
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        start()
+
+        Start polling in a background thread
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=transport.carry(self._run))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        stop()
+
+        Stop polling and flush memory mapped buffers, they can still be
+        queried
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for rings in (self._samples, self._jobs):
+            for ring in rings.values():
+                ring.flush()
+
+    def arches(self):
+        """
+        arches() -> list
+
+        Returns the architectures seen so far
+        """
+        with self._lock:
+            return sorted(set(self._samples) | set(self._jobs))
+
+    def _window(self, rings, arch, since, until):
+        with self._lock:
+            ring = rings.get(arch)
+        if ring is None:
+            return []
+        return ring.window(since, until)
+
+    def utilization(self, arch, since=None, until=None, points=(50, 90, 99)):
+        """
+        utilization(arch, since=None, until=None, points=(50, 90, 99)) -> dict
+
+        Returns percentiles of the busy fraction of the workers of arch
+        between the time stamps since and until
+        """
+        values = [busy / (busy + idle)
+                  for (stamp, busy, idle, waiting, blocked) in
+                  self._window(self._samples, arch, since, until)
+                  if busy + idle]
+        return percentiles(values, points)
+
+    def queueDepth(self, arch, since=None, until=None, step=3600):
+        """
+        queueDepth(arch, since=None, until=None, step=3600) -> list
+
+        Returns the trend of waiting jobs for arch as a list of
+        (start, mean, max) tuples for each 'step' seconds long bucket with
+        samples
+        """
+        buckets = []
+        for (stamp, busy, idle, waiting, blocked) in \
+                self._window(self._samples, arch, since, until):
+            start = stamp - stamp % step
+            if not buckets or buckets[-1][0] != start:
+                buckets.append([start, 0.0, 0, 0])
+            bucket = buckets[-1]
+            bucket[1] += waiting
+            bucket[2] = max(bucket[2], int(waiting))
+            bucket[3] += 1
+        return [(first, total / n, peak) for (first, total, peak, n) in buckets]
+
+    def jobDurations(self, arch, since=None, until=None, points=(50, 90, 99)):
+        """
+        jobDurations(arch, since=None, until=None, points=(50, 90, 99)) -> dict
+
+        Returns percentiles of the durations in seconds of the jobs of arch
+        which ended between since and until
+        """
+        return percentiles([duration for (stamp, duration) in
+                            self._window(self._jobs, arch, since, until)], points)
@@ -0,0 +1,304 @@
+#
+# tracing.py - Call tree tracing of BuildService methods and HTTP requests
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Tracing is off until enable() is called. From then on the public methods of
+BuildService and every HTTP request record spans, nested by call, which are
+grouped into one trace per outermost call:
+
+    tracer = tracing.enable(sample_rate=0.1, path='/tmp/bs-traces.json')
+    bs.genRequestInfo(reqid)
+    json.dump(tracing.chrome_trace(tracer.traces), open('trace.json', 'w'))
+
+chrome_trace() output loads in chrome://tracing or Perfetto, the output of
+collapsed_stacks() in flamegraph.pl.
+"""
+
+import collections
+import inspect
+import itertools
+import json
+import os
+import random
+import thread
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_local = threading.local()
+_ids = itertools.count(1)
+# marks the call stack of a trace which was not sampled
+_unsampled = object()
+
+tracer = None
+
+
+class Span(object):
+    """
+    Span(trace, name, parent, attrs)
+
+    One timed call. parent is the id of the enclosing span, None for the
+    root of a trace. attrs is a dict of details like the URL or status of
+    an HTTP request.
+    """
+    __slots__ = ('trace', 'id', 'name', 'parent', 'tid', 'start', 'end', 'attrs')
+
+    def __init__(self, trace, name, parent, attrs):
+        self.trace = trace
+        self.id = next(_ids)
+        self.name = name
+        self.parent = parent
+        self.tid = thread.get_ident()
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
+
+    def as_dict(self):
+        return {'id': self.id, 'name': self.name, 'parent': self.parent,
+                'tid': self.tid, 'start': self.start, 'end': self.end,
+                'attrs': self.attrs}
+
+
+class Tracer(object):
+    """
+    Tracer(sample_rate=1.0, path=None, keep=100)
+
+    Collects traces. Only the given fraction of outermost calls is traced.
+    The last 'keep' finished traces are kept in self.traces, each a list of
+    span dicts, and every finished trace is appended to the file at path as
+    one line of JSON if path is given.
+    """
+    def __init__(self, sample_rate=1.0, path=None, keep=100):
+        self.sample_rate = sample_rate
+        self.path = path
+        self.traces = collections.deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def finish(self, spans):
+        # spans of threads outliving the outermost call are dropped
+        trace = [s.as_dict() for s in spans if s.end is not None]
+        with self._lock:
+            self.traces.append(trace)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(trace) + '\n')
+
+
+def enable(sample_rate=1.0, path=None, keep=100):
+    """
+    enable(sample_rate=1.0, path=None, keep=100) -> Tracer
+
+    Start tracing with a new Tracer
+    """
+    global tracer
+    tracer = Tracer(sample_rate, path, keep)
+    return tracer
+
+
+def disable():
+    """
+    disable()
+
+    Stop tracing
+    """
+    global tracer
+    tracer = None
+
+
+def current():
+    """
+    current() -> Span or None
+
+    Returns the innermost span of the current thread
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+@contextmanager
+def adopt(parent):
+    """
+    adopt(parent)
+
+    Context manager making the spans of the current thread children of
+    parent, a span of another thread
+    """
+    if parent is None:
+        yield
+        return
+    old = getattr(_local, 'stack', None)
+    _local.stack = [parent]
+    try:
+        yield
+    finally:
+        _local.stack = old
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    span(name, **attrs) -> Span or None
+
+    Context manager timing the enclosed code as a span, yields the Span so
+    attributes can be added, or None when not tracing
+    """
+    t = tracer
+    parent = current()
+    if t is None or parent is _unsampled:
+        yield None
+        return
+    if not hasattr(_local, 'stack') or _local.stack is None:
+        _local.stack = []
+    if parent is None:
+        if random.random() >= t.sample_rate:
+            _local.stack.append(_unsampled)
+            try:
+                yield None
+            finally:
+                _local.stack.pop()
+            return
+        s = Span([], name, None, attrs)
+    else:
+        s = Span(parent.trace, name, parent.id, attrs)
+    s.trace.append(s)
+    _local.stack.append(s)
+    try:
+        yield s
+    except Exception as e:
+        s.attrs['error'] = repr(e)
+        raise
+    finally:
+        s.end = time.time()
+        _local.stack.pop()
+        if s.parent is None:
+            t.finish(s.trace)
+
+
+# all functions decorated with contextlib.contextmanager share this code
+_contextmanager_code = contextmanager(lambda: None).func_code
+
+
+def iscontextmanager(func):
+    """
+    iscontextmanager(func) -> Bool
+
+    Tells whether func was decorated with contextlib.contextmanager
+    """
+    return getattr(func, 'func_code', None) is _contextmanager_code
+
+
+def traced(cls):
+    """
+    traced(cls) -> cls
+
+    Class decorator recording a span for every call of the public methods
+    of cls. The span of a context manager method covers the whole with
+    block. Generator functions are left alone, their work happens after
+    they return.
+    """
+    prefix = cls.__name__ + '.'
+    for (name, func) in cls.__dict__.items():
+        if name.startswith('_') or not inspect.isfunction(func) or \
+                inspect.isgeneratorfunction(func):
+            continue
+        def wrap(func, name):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if tracer is None:
+                    return func(*args, **kwargs)
+                with span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        def wrap_contextmanager(func, name):
+            @contextmanager
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    with func(*args, **kwargs) as value:
+                        yield value
+            return wrapper
+        if iscontextmanager(func):
+            setattr(cls, name, wrap_contextmanager(func, prefix + name))
+        else:
+            setattr(cls, name, wrap(func, prefix + name))
+    return cls
+
+
+def load(path):
+    """
+    load(path) -> list
+
+    Returns the traces written to the file at path
+    """
+    traces = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    traces.append(json.loads(line))
+    return traces
+
+
+def chrome_trace(traces):
+    """
+    chrome_trace(traces) -> dict
+
+    Returns traces in the Chrome trace event format
+    """
+    events = []
+    for trace in traces:
+        for s in trace:
+            events.append({'name': s['name'],
+                           'cat': 'http' if 'method' in s['attrs'] else 'call',
+                           'ph': 'X',
+                           'ts': int(s['start'] * 1e6),
+                           'dur': int((s['end'] - s['start']) * 1e6),
+                           'pid': os.getpid(),
+                           'tid': s['tid'],
+                           'args': s['attrs']})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def collapsed_stacks(traces):
+    """
+    collapsed_stacks(traces) -> str
+
+    Returns traces as collapsed stacks, one 'root;child;leaf microseconds'
+    line per call path with the time spent in it outside of its children
+    """
+    totals = collections.defaultdict(int)
+    for trace in traces:
+        spans = dict((s['id'], s) for s in trace)
+        child_time = collections.defaultdict(float)
+        for s in trace:
+            if s['parent'] in spans:
+                child_time[s['parent']] += s['end'] - s['start']
+        for s in trace:
+            path = []
+            node = s
+            while node is not None:
+                path.append(node['name'].replace(';', ':').replace(' ', '_'))
+                node = spans.get(node['parent'])
+            # children running in parallel threads can take longer than
+            # their parent
+            own = max(0.0, s['end'] - s['start'] - child_time[s['id']])
+            totals[';'.join(reversed(path))] += int(own * 1e6)
+    return ''.join('%s %d\n' % (path, value) for (path, value) in sorted(totals.items()))
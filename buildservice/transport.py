@@ -0,0 +1,1360 @@
+#
+# transport.py - HTTP request path shared by all BuildService instances
+#
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+All HTTP requests done through osc.core end up in core.http_request. install()
+replaces it once per process so that every request towards an API server
+passes an AdmissionController for that server first.
+
+Unlike osc, which installs a process global urllib2 opener for every request,
+requests are sent with an opener kept per API server, so threads can talk to
+several servers at the same time. The openers come from osc's private
+conf._build_opener(), which also sets up authentication, proxies and the
+http_full_debug output, and cookies are kept in conf.cookiejar like osc
+does; both exist in osc 0.13x up to at least 0.167. With an osc lacking
+them requests are handed to osc's own http_request instead, sequentially
+as osc's global opener is not thread safe.
+
+Callers can bound the time of their requests with deadline() and opt in to
+hedged GET requests with hedging(), for example:
+
+    with transport.deadline(5), transport.hedging():
+        bs.getProjectResults(project)
+"""
+
+import collections
+import cookielib
+import copy
+import hashlib
+import heapq
+import inspect
+import itertools
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import zlib
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from functools import wraps
+from urlparse import urlsplit, parse_qs
+from osc import conf, core
+
+import tracing
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+_local = threading.local()
+
+
+def current_priority():
+    """
+    current_priority() -> int
+
+    Returns the priority lane of requests done by the current thread
+    """
+    return getattr(_local, 'priority', None)
+
+
+@contextmanager
+def priority(level, override=True):
+    """
+    priority(level, override=True)
+
+    Context manager putting the requests done by the current thread in the
+    INTERACTIVE, NORMAL or BULK lane. With override=False an already chosen
+    lane is kept.
+    """
+    old = current_priority()
+    if override or old is None:
+        _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = old
+
+
+def current_timeout():
+    """
+    current_timeout() -> float or None
+
+    Returns the socket timeout for requests done by the current thread
+    """
+    return getattr(_local, 'timeout', None)
+
+
+@contextmanager
+def timeout(seconds):
+    """
+    timeout(seconds)
+
+    Context manager setting the socket timeout of the requests done by the
+    current thread
+    """
+    old = current_timeout()
+    _local.timeout = seconds
+    try:
+        yield
+    finally:
+        _local.timeout = old
+
+
+def carry(func):
+    """
+    carry(func) -> function
+
+    Wrap func so that it runs with the request context (priority lane,
+    timeout, deadline, tracing span) of the calling thread, for handing
+    work to other threads
+    """
+    context = dict(_local.__dict__)
+    parent = tracing.current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        saved = dict(_local.__dict__)
+        _local.__dict__.update(context)
+        try:
+            with tracing.adopt(parent):
+                return func(*args, **kwargs)
+        finally:
+            _local.__dict__.clear()
+            _local.__dict__.update(saved)
+    return wrapper
+
+
+def parallel_map(func, items, workers=8):
+    """
+    parallel_map(func, items, workers=8) -> list
+
+    Returns [func(item) for item in items], computed by a pool of at most
+    'workers' threads which keep the request context of the caller
+    """
+    items = list(items)
+    if len(items) < 2 or workers < 2:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(carry(func), items)
+    finally:
+        pool.close()
+
+
+def parallel_imap(func, items, workers=8):
+    """
+    parallel_imap(func, items, workers=8) -> generator
+
+    Like parallel_map, but yields the results in the order they complete.
+    Work not started yet is dropped when the generator is closed early.
+    """
+    items = list(items)
+    if len(items) < 2 or workers < 2:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap_unordered(carry(func), items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def prioritized(level):
+    """
+    prioritized(level) -> decorator
+
+    Run the decorated function in the given lane unless the caller already
+    picked one
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with priority(level, override=False):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SingleFlight(object):
+    """
+    SingleFlight()
+
+    Lets concurrent identical calls share one execution: the first caller
+    for a key runs the call, callers arriving while it is in flight wait
+    for its result (or exception) instead of running it again.
+
+    Waiting callers stop at their own deadline, see deadline(). A timeout
+    the first caller ran into because of its own deadline or timeout() is
+    not passed on, the waiting callers run the call again instead.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, func, timeout=30):
+        """
+        do(key, func, timeout=30) -> (result, shared)
+
+        Run func() unless a call for key is in flight already. A caller
+        waiting longer than timeout seconds gives up and runs func() itself,
+        one whose deadline passed while waiting raises socket.timeout.
+        shared tells whether the result went to more than one caller.
+        """
+        with self._lock:
+            self.calls += 1
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = {'done': threading.Event(), 'waiters': 0}
+                    self._flights[key] = flight
+                    break
+                flight['waiters'] += 1
+
+            wait = timeout
+            end = current_deadline()
+            if end is not None:
+                wait = min(wait, end - time.time())
+            if wait > 0 and flight['done'].wait(wait):
+                if flight.get('private'):
+                    # the leader ran out of its own time, try again
+                    continue
+                with self._lock:
+                    self.shared += 1
+                if 'error' in flight:
+                    (cls, error, tb) = flight['error']
+                    raise cls, error, tb
+                return (flight['result'], True)
+            with self._lock:
+                self.timeouts += 1
+            if end is not None and end <= time.time():
+                raise socket.timeout('deadline exceeded')
+            return (func(), False)
+
+        try:
+            flight['result'] = func()
+        except Exception as e:
+            flight['error'] = sys.exc_info()
+            # a timeout caused by limits of this caller only
+            flight['private'] = _is_timeout(e) and \
+                (current_deadline() is not None or current_timeout() is not None)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                shared = flight['waiters'] > 0
+            flight['done'].set()
+        return (flight['result'], shared)
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        Returns the number of calls, of calls which got a shared result and
+        of callers which gave up waiting
+        """
+        with self._lock:
+            return {'calls': self.calls,
+                    'shared': self.shared,
+                    'timeouts': self.timeouts,
+                    'inflight': len(self._flights)}
+
+
+flights = SingleFlight()
+
+
+def coalesced(timeout=30):
+    """
+    coalesced(timeout=30) -> decorator
+
+    Coalesce concurrent calls of a read only BuildService method with equal
+    arguments into one, see SingleFlight. When the result is shared every
+    caller receives its own deep copy of it.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            # instances for the same server may use different credentials
+            key = (func.__name__, self.apiurl, getattr(self, 'session', None), args,
+                   tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return func(self, *args, **kwargs)
+            (result, shared) = flights.do(key, lambda: func(self, *args, **kwargs), timeout)
+            if shared:
+                result = copy.deepcopy(result)
+            return result
+        return wrapper
+    return decorator
+
+
+class AdmissionController(object):
+    """
+    AdmissionController(rate=20.0, burst=40, concurrency=8, min_concurrency=1,
+                        max_concurrency=32)
+
+    Admits requests to one API server. A token bucket limits the request rate
+    to 'rate' per second with bursts of 'burst' requests (rate=None disables
+    it). The number of requests in flight, from admission until their
+    response body was read or closed, is limited by an AIMD window which
+    grows by one request per window of successful requests and is halved
+    when the server answers with 5xx/429 or times out before the deadline
+    of the caller, see deadline().
+
+    Waiting requests are admitted by priority lane, then in arrival order.
+    """
+    def __init__(self, rate=20.0, burst=40, concurrency=8, min_concurrency=1,
+                 max_concurrency=32):
+        self.rate = rate
+        self.burst = burst
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.inflight = 0
+        self.tokens = float(burst)
+        self.cond = threading.Condition()
+        self._stamp = time.time()
+        self._last_backoff = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.delayed = 0
+        self.backoffs = 0
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(float(self.burst),
+                              self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, level=NORMAL, deadline=None):
+        """
+        acquire(level=NORMAL, deadline=None)
+
+        Block until a request in the given lane may be sent. Raises
+        socket.timeout if that is not the case by the time 'deadline'.
+        """
+        waiter = (level, next(self._seq))
+        with self.cond:
+            heapq.heappush(self._waiters, waiter)
+            waited = False
+            while True:
+                now = time.time()
+                self._refill(now)
+                timeout = None
+                if self._waiters[0] == waiter and self.inflight < int(self.limit):
+                    if not self.rate or self.tokens >= 1:
+                        break
+                    timeout = (1 - self.tokens) / self.rate
+                if deadline is not None:
+                    if now >= deadline:
+                        self._waiters.remove(waiter)
+                        heapq.heapify(self._waiters)
+                        self.cond.notify_all()
+                        raise socket.timeout('deadline exceeded')
+                    timeout = min(timeout, deadline - now) if timeout else deadline - now
+                waited = True
+                self.cond.wait(timeout)
+            heapq.heappop(self._waiters)
+            if self.rate:
+                self.tokens -= 1
+            self.inflight += 1
+            self.admitted += 1
+            if waited:
+                self.delayed += 1
+            # the next waiter may be admissible as well
+            self.cond.notify_all()
+
+    def release(self, overloaded=False):
+        """
+        release(overloaded=False)
+
+        Return the slot of a finished request. overloaded tells whether the
+        server was struggling with it.
+        """
+        with self.cond:
+            self.inflight -= 1
+            now = time.time()
+            if overloaded:
+                # Back off at most once per second, a whole window of failing
+                # requests is a single congestion event
+                if now - self._last_backoff > 1.0:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self._last_backoff = now
+                    self.backoffs += 1
+            else:
+                self.limit = min(float(self.max_concurrency),
+                                 self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        Returns the current window and request counters
+        """
+        with self.cond:
+            return {'limit': int(self.limit),
+                    'inflight': self.inflight,
+                    'waiting': len(self._waiters),
+                    'admitted': self.admitted,
+                    'delayed': self.delayed,
+                    'backoffs': self.backoffs}
+
+
+_controllers = {}
+_settings = {}
+_lock = threading.Lock()
+
+
+def server_of(url):
+    """
+    server_of(url) -> str
+
+    Returns the scheme://host part of url which identifies the API server
+    """
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+def configure(apiurl, **kwargs):
+    """
+    configure(apiurl, **kwargs)
+
+    Set the AdmissionController arguments used for apiurl. Requests already
+    waiting or in flight finish under the previous settings.
+    """
+    server = server_of(apiurl)
+    with _lock:
+        _settings[server] = kwargs
+        _controllers[server] = AdmissionController(**kwargs)
+
+
+def controller(apiurl):
+    """
+    controller(apiurl) -> AdmissionController
+
+    Returns the AdmissionController shared by all requests to apiurl
+    """
+    server = server_of(apiurl)
+    with _lock:
+        if server not in _controllers:
+            _controllers[server] = AdmissionController(**_settings.get(server, {}))
+        return _controllers[server]
+
+
+def _is_timeout(error):
+    if isinstance(error, urllib2.URLError) and not isinstance(error, urllib2.HTTPError):
+        return isinstance(error.reason, socket.timeout)
+    return isinstance(error, socket.timeout)
+
+
+def is_overload(error):
+    """
+    is_overload(error) -> Bool
+
+    Tells whether a request failing with error indicates an overloaded server
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    if isinstance(error, urllib2.URLError):
+        return isinstance(error.reason, socket.timeout)
+    return isinstance(error, socket.timeout)
+
+
+_openers = {}
+# osc.conf keeps its configuration in module globals
+_config_lock = threading.RLock()
+
+
+class Session(object):
+    """
+    Session(oscrc=None)
+
+    The osc configuration read from oscrc (the default osc configuration
+    file if None) together with the openers holding the credentials and
+    cookies of its API servers, so several configurations can be used in
+    one process.
+
+    osc.conf only reads a configuration into its globals. A Session leaves
+    them alone once they hold one, as osc.core functions called directly
+    rely on them, otherwise they keep the configuration of the first
+    Session. Requests done while a Session is current, see session() and
+    bound(), use the Session, all others the osc globals.
+
+    A Session for an oscrc other than the default one keeps its cookies in
+    a cookie jar file of its own, unless the oscrc names one.
+    """
+    def __init__(self, oscrc=None):
+        with _config_lock:
+            saved = (conf.config, getattr(conf, 'cookiejar', None),
+                     dict(conf.get_configParser.__dict__))
+            try:
+                if oscrc:
+                    conf.get_config(override_conffile=oscrc)
+                else:
+                    conf.get_config()
+                self.config = conf.config
+                self.cookiejar = getattr(conf, 'cookiejar', None)
+            finally:
+                if 'api_host_options' in saved[0]:
+                    (conf.config, conf.cookiejar) = saved[:2]
+                    conf.get_configParser.__dict__.clear()
+                    conf.get_configParser.__dict__.update(saved[2])
+        if oscrc and self.config.get('cookiejar') == conf.DEFAULTS.get('cookiejar'):
+            path = os.path.realpath(os.path.expanduser(oscrc))
+            if path != os.path.realpath(os.path.expanduser(conf.identify_conf())):
+                self.config = dict(self.config, cookiejar='%s.%s' % (
+                    self.config['cookiejar'], hashlib.md5(path).hexdigest()[:8]))
+                self.cookiejar = _cookiejar(os.path.expanduser(self.config['cookiejar']))
+        self._lock = threading.Lock()
+        self._openers = {}
+        # older osc versions key the host options by host name only
+        self.apiurls = {}
+        for host in self.config['api_host_options']:
+            if '://' in host:
+                self.apiurls[host] = host
+            else:
+                self.apiurls['%s://%s' % (self.config.get('scheme', 'https'), host)] = host
+
+    def known_apiurl(self, url):
+        """
+        known_apiurl(url) -> str or None
+
+        Returns the apiurl of this configuration url belongs to, the longest
+        one if several match, None for other urls
+        """
+        found = None
+        for apiurl in self.apiurls:
+            if url == apiurl or url.startswith(apiurl.rstrip('/') + '/'):
+                if found is None or len(apiurl) > len(found):
+                    found = apiurl
+        return found
+
+    def host_options(self, apiurl):
+        """
+        host_options(apiurl) -> dict
+
+        Returns the configured options, like credentials, of apiurl
+        """
+        return self.config['api_host_options'][self.apiurls.get(apiurl, apiurl)]
+
+    def opener(self, apiurl):
+        """
+        opener(apiurl) -> urllib2.OpenerDirector
+
+        Returns the opener with the credentials and cookies for apiurl
+        """
+        with self._lock:
+            if apiurl not in self._openers:
+                with _config_lock:
+                    saved = (conf.config, getattr(conf, 'cookiejar', None))
+                    (conf.config, conf.cookiejar) = (self.config, self.cookiejar)
+                    # osc caches the last opener, whatever config it was for
+                    conf._build_opener.last_opener = (None, None)
+                    try:
+                        self._openers[apiurl] = conf._build_opener(apiurl)
+                    finally:
+                        (conf.config, conf.cookiejar) = saved
+                        conf._build_opener.last_opener = (None, None)
+            return self._openers[apiurl]
+
+    def save_cookies(self):
+        """
+        save_cookies()
+
+        Write the cookies of this configuration back to its cookie jar file
+        """
+        if hasattr(self.cookiejar, 'save'):
+            with self._lock:
+                self.cookiejar.save(ignore_discard=True)
+
+
+def _cookiejar(path):
+    # like osc does for its cookie jar file
+    jar = cookielib.LWPCookieJar(path)
+    try:
+        jar.load(ignore_discard=True)
+    except IOError:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0600))
+        except OSError:
+            return cookielib.CookieJar()
+    return jar
+
+
+def current_session():
+    """
+    current_session() -> Session or None
+
+    Returns the Session used by the requests of the current thread
+    """
+    return getattr(_local, 'session', None)
+
+
+@contextmanager
+def session(s):
+    """
+    session(s)
+
+    Context manager making the current thread use Session s for its
+    requests
+    """
+    old = current_session()
+    _local.session = s
+    try:
+        yield
+    finally:
+        _local.session = old
+
+
+@contextmanager
+def _using(s):
+    # session(s) unless s is None or already current
+    if s is None or current_session() is s:
+        yield
+    else:
+        with session(s):
+            yield
+
+
+def in_session(s, func):
+    """
+    in_session(s, func) -> function
+
+    Returns a function calling func with Session s current
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _using(s):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def bound(cls):
+    """
+    bound(cls) -> cls
+
+    Class decorator running the public methods of cls, which must have a
+    'session' attribute, with the Session of the instance if it is not
+    None. Generator functions run with it for every item they produce,
+    context managers for entering and exiting.
+    """
+    for (name, func) in cls.__dict__.items():
+        if name.startswith('_') or not inspect.isfunction(func):
+            continue
+        def wrap(func):
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                with _using(self.session):
+                    return func(self, *args, **kwargs)
+            return wrapper
+        def wrap_generator(func):
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                gen = func(self, *args, **kwargs)
+                try:
+                    while True:
+                        with _using(self.session):
+                            item = next(gen)
+                        yield item
+                finally:
+                    with _using(self.session):
+                        gen.close()
+            return wrapper
+        def wrap_contextmanager(func):
+            @contextmanager
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                manager = func(self, *args, **kwargs)
+                with _using(self.session):
+                    value = manager.__enter__()
+                try:
+                    yield value
+                except:
+                    with _using(self.session):
+                        if not manager.__exit__(*sys.exc_info()):
+                            raise
+                else:
+                    with _using(self.session):
+                        manager.__exit__(None, None, None)
+            return wrapper
+        if tracing.iscontextmanager(func):
+            setattr(cls, name, wrap_contextmanager(func))
+        elif inspect.isgeneratorfunction(func):
+            setattr(cls, name, wrap_generator(func))
+        else:
+            setattr(cls, name, wrap(func))
+    return cls
+
+
+def session_for(url):
+    """
+    session_for(url) -> Session or None
+
+    Returns the Session for a request to url, the current one if it knows
+    url. Other requests use the osc configuration globals.
+    """
+    s = current_session()
+    if s is not None and s.known_apiurl(url):
+        return s
+    return None
+
+
+def known_apiurl(url):
+    """
+    known_apiurl(url) -> str or None
+
+    Returns the configured apiurl url belongs to, None for other urls
+    """
+    s = session_for(url)
+    if s is not None:
+        return s.known_apiurl(url)
+    with _config_lock:
+        if hasattr(conf, 'extract_known_apiurl'):
+            return conf.extract_known_apiurl(url)
+        server = server_of(url)
+        if conf.is_known_apiurl(server):
+            return server
+    return None
+
+
+def opener(apiurl):
+    """
+    opener(apiurl) -> urllib2.OpenerDirector
+
+    Returns the opener with the credentials and cookies for apiurl from the
+    global osc configuration, or a plain one if apiurl is None
+    """
+    with _lock:
+        if not apiurl:
+            if apiurl not in _openers:
+                _openers[apiurl] = (None, urllib2.build_opener())
+            return _openers[apiurl][1]
+        with _config_lock:
+            # rebuilt when a configuration was loaded since
+            if apiurl not in _openers or _openers[apiurl][0] is not conf.config:
+                # osc caches the last opener, whatever config it was for
+                conf._build_opener.last_opener = (None, None)
+                _openers[apiurl] = (conf.config, conf._build_opener(apiurl))
+            return _openers[apiurl][1]
+
+
+# Ask for gzip compressed responses to GET requests
+accept_gzip = True
+
+_transfer = {'responses': 0, 'compressed': 0, 'decompressed': 0}
+
+
+def transfer_stats():
+    """
+    transfer_stats() -> dict
+
+    Returns the number of gzip compressed responses, their compressed and
+    decompressed size read so far and the bytes saved by compression
+    """
+    with _lock:
+        stats = dict(_transfer)
+    stats['saved'] = stats['decompressed'] - stats['compressed']
+    return stats
+
+
+class GzipStream(object):
+    """
+    GzipStream(fp, chunk=64*1024)
+
+    File like object decompressing the gzip stream read from fp as it is
+    read, holding at most a few chunks in memory
+    """
+    def __init__(self, fp, chunk=64*1024):
+        self.fp = fp
+        self.chunk = chunk
+        self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buf = ''
+        self._eof = False
+
+    def _fill(self, size):
+        # decompress until size bytes are buffered, everything if size < 0
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            data = self._z.unconsumed_tail
+            if not data:
+                data = self.fp.read(self.chunk)
+                if not data:
+                    self._buf += self._z.flush()
+                    self._eof = True
+                    break
+                with _lock:
+                    _transfer['compressed'] += len(data)
+            out = self._z.decompress(data, self.chunk * 4)
+            with _lock:
+                _transfer['decompressed'] += len(out)
+            self._buf += out
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            (data, self._buf) = (self._buf, '')
+        else:
+            (data, self._buf) = (self._buf[:size], self._buf[size:])
+        return data
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buf.find('\n')
+            if end >= 0 or self._eof or 0 <= size <= len(self._buf):
+                break
+            self._fill(len(self._buf) + self.chunk)
+        if end < 0:
+            end = len(self._buf)
+        else:
+            end += 1
+        if size >= 0:
+            end = min(end, size)
+        (line, self._buf) = (self._buf[:end], self._buf[end:])
+        return line
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fp.close()
+
+
+def _decompressed(f):
+    # Wrap a gzip encoded response. The size headers describe the compressed
+    # body, readers like core.streamfile must not check against them.
+    info = f.info()
+    if (info.getheader('content-encoding') or '').lower() != 'gzip':
+        return f
+    length = info.getheader('content-length')
+    del info['content-encoding']
+    del info['content-length']
+    with _lock:
+        _transfer['responses'] += 1
+    if isinstance(f, urllib2.HTTPError):
+        return urllib2.HTTPError(f.geturl(), f.code, f.msg, info, GzipStream(f.fp))
+    result = urllib.addinfourl(GzipStream(f.fp), info, f.geturl(), f.code)
+    result.msg = f.msg
+    result.compressed_length = length
+    return result
+
+
+# osc's own http_request, used if osc cannot build openers for us
+_osc_http_request = core.http_request
+_osc_lock = threading.Lock()
+
+
+def _osc_send(method, url, headers, data, file, timeout):
+    args = {}
+    if 'timeout' in inspect.getargspec(_osc_http_request).args:
+        args['timeout'] = timeout
+    with _osc_lock:
+        s = current_session()
+        if s is None:
+            return _osc_http_request(method, url, headers or {}, data, file, **args)
+        with _config_lock:
+            saved = (conf.config, getattr(conf, 'cookiejar', None))
+            (conf.config, conf.cookiejar) = (s.config, s.cookiejar)
+            try:
+                return _osc_http_request(method, url, headers or {}, data, file, **args)
+            finally:
+                (conf.config, conf.cookiejar) = saved
+
+
+def send(method, url, headers=None, data=None, file=None, timeout=None):
+    """
+    send(method, url, headers=None, data=None, file=None, timeout=None) -> response
+
+    Send a request like osc.core.http_request does, without admission
+    """
+    if not hasattr(conf, '_build_opener'):
+        return _osc_send(method, url, headers, data, file, timeout)
+    req = urllib2.Request(url)
+    req.get_method = lambda: method
+    s = session_for(url)
+    apiurl = s.known_apiurl(url) if s else known_apiurl(url)
+    if s:
+        options = s.host_options(apiurl)
+    elif apiurl:
+        with _config_lock:
+            options = conf.get_apiurl_api_host_options(apiurl)
+    if apiurl:
+        for (header, value) in options.get('http_headers', []):
+            req.add_header(header, value)
+
+    if method == 'POST' and not file and not data:
+        # adding data to an urllib2 request transforms it into a POST
+        data = ''
+    # POST requests are application/x-www-form-urlencoded per default
+    # but sending data requires an octet-stream type
+    if method == 'PUT' or (method == 'POST' and (data or file)):
+        req.add_header('Content-Type', 'application/octet-stream')
+    if method == 'GET' and accept_gzip:
+        req.add_header('Accept-Encoding', 'gzip')
+    for (header, value) in (headers or {}).items():
+        req.add_header(header, value)
+
+    filefd = None
+    if file and not data:
+        size = os.path.getsize(file)
+        filefd = open(file, 'rb')
+        if size < 1024*512:
+            data = filefd.read()
+        else:
+            # httplib streams file objects, it only needs to know the size
+            req.add_header('Content-Length', str(size))
+            data = filefd
+
+    config = s.config if s else conf.config
+    if config.get('http_debug'):
+        print >>sys.stderr, '\n\n--', method, url
+    if config.get('debug'):
+        print >>sys.stderr, method, url
+
+    if timeout is None:
+        timeout = current_timeout() or socket._GLOBAL_DEFAULT_TIMEOUT
+    try:
+        if s:
+            return _decompressed(s.opener(apiurl).open(req, data, timeout))
+        return _decompressed(opener(apiurl).open(req, data, timeout))
+    except urllib2.HTTPError as e:
+        raise _decompressed(e), None, sys.exc_info()[2]
+    finally:
+        if filefd:
+            filefd.close()
+        if s:
+            s.save_cookies()
+        else:
+            cookiejar = getattr(conf, 'cookiejar', None)
+            if apiurl and hasattr(cookiejar, 'save'):
+                with _lock:
+                    cookiejar.save(ignore_discard=True)
+
+
+class LatencyTracker(object):
+    """
+    LatencyTracker(size=200, min_samples=20)
+
+    Keeps the last 'size' GET latencies (time until the response headers
+    arrived) per endpoint class, see endpoint_class(), and counts hedged
+    requests.
+    """
+    def __init__(self, size=200, min_samples=20):
+        self.size = size
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def add(self, cls, seconds):
+        """
+        add(cls, seconds)
+
+        Record the latency of a request to endpoint class cls
+        """
+        with self._lock:
+            self._samples.setdefault(cls, collections.deque(maxlen=self.size)).append(seconds)
+
+    def percentile(self, cls, p=95):
+        """
+        percentile(cls, p=95) -> float or None
+
+        Returns the p-th percentile latency of endpoint class cls, None until
+        min_samples latencies are known
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(cls, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def count(self, won):
+        with self._lock:
+            self.hedged += 1
+            if won:
+                self.hedge_wins += 1
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        Returns the p50 and p95 latency per endpoint class, the number of
+        hedge requests sent and how many of them answered first
+        """
+        classes = {}
+        with self._lock:
+            names = list(self._samples)
+        for cls in names:
+            classes[cls] = (self.percentile(cls, 50), self.percentile(cls, 95))
+        with self._lock:
+            return {'classes': classes,
+                    'hedged': self.hedged,
+                    'hedge_wins': self.hedge_wins}
+
+
+latencies = LatencyTracker()
+
+
+def endpoint_class(url):
+    """
+    endpoint_class(url) -> str
+
+    Returns the class of API endpoint url belongs to, like 'build/_result'
+    for any project's results or 'source/3' for any package directory
+    """
+    parts = [p for p in urlsplit(url).path.split('/') if p]
+    if not parts:
+        return '/'
+    if len(parts) > 1 and parts[-1].startswith('_'):
+        return '%s/%s' % (parts[0], parts[-1])
+    return '%s/%d' % (parts[0], len(parts))
+
+
+def url_template(url):
+    """
+    url_template(url) -> str
+
+    Returns the path of url with the project, package and other names
+    replaced by '*', and the cmd parameter if any, like
+    '/source/*/*?cmd=diff'
+    """
+    parts = urlsplit(url)
+    path = '/'.join(p if p.startswith('_') or i == 0 else '*'
+                    for (i, p) in enumerate(x for x in parts.path.split('/') if x))
+    cmd = parse_qs(parts.query).get('cmd')
+    if cmd:
+        return '/%s?cmd=%s' % (path, cmd[0])
+    return '/' + path
+
+
+def current_deadline():
+    """
+    current_deadline() -> float or None
+
+    Returns the time by which requests done by the current thread have to
+    be answered
+    """
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    deadline(seconds)
+
+    Context manager failing the requests done by the current thread with
+    socket.timeout once 'seconds' have passed. Nested deadlines can only
+    shorten the outer one.
+    """
+    old = current_deadline()
+    end = time.time() + seconds
+    if old is not None:
+        end = min(old, end)
+    _local.deadline = end
+    try:
+        yield
+    finally:
+        _local.deadline = old
+
+
+@contextmanager
+def hedging(enabled=True):
+    """
+    hedging(enabled=True)
+
+    Context manager enabling hedged GET requests for the current thread: a
+    GET not answered within the p95 latency of its endpoint class is sent a
+    second time and the first answer wins. Other methods are never hedged.
+    """
+    old = getattr(_local, 'hedging', False)
+    _local.hedging = enabled
+    try:
+        yield
+    finally:
+        _local.hedging = old
+
+
+@contextmanager
+def longpoll(enabled=True):
+    """
+    longpoll(enabled=True)
+
+    Context manager marking the requests done by the current thread as long
+    polls, which the server only answers once something changed. They are
+    sent without admission, so they don't hold a slot while waiting, and
+    neither their latency nor their timeouts are recorded.
+    """
+    old = getattr(_local, 'longpoll', False)
+    _local.longpoll = enabled
+    try:
+        yield
+    finally:
+        _local.longpoll = old
+
+
+def _remaining(timeout):
+    # socket timeout of a request, bounded by the deadline
+    end = current_deadline()
+    if end is None:
+        return timeout
+    left = end - time.time()
+    if left <= 0:
+        raise socket.timeout('deadline exceeded')
+    if timeout is None:
+        timeout = current_timeout()
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+
+def _overloaded(error, end):
+    # Tells whether error of a request under deadline end hints at server
+    # overload. Timeouts of the caller's own deadline, including those of
+    # hedged attempts, say nothing about the server.
+    if not is_overload(error):
+        return False
+    if isinstance(error, urllib2.HTTPError) or end is None:
+        return True
+    # socket timeouts may fire a little early
+    return time.time() < end - 0.01
+
+
+class _Body(object):
+    """
+    _Body(fp, admission, end=None)
+
+    File like object reading the body of an admitted response from fp,
+    which returns the admission slot of the request once the body was read
+    to the end, or the response was closed or dropped. end is the deadline
+    of the request.
+    """
+    def __init__(self, fp, admission, end=None):
+        self.fp = fp
+        self._admission = admission
+        self._end = end
+        self._lock = threading.Lock()
+
+    def _release(self, overloaded=False):
+        with self._lock:
+            (admission, self._admission) = (self._admission, None)
+        if admission is not None:
+            admission.release(overloaded)
+
+    def _call(self, name, *args):
+        try:
+            return getattr(self.fp, name)(*args)
+        except Exception as e:
+            self._release(_overloaded(e, self._end))
+            raise
+
+    def read(self, size=-1):
+        data = self._call('read', size)
+        if not data or size < 0:
+            self._release()
+        return data
+
+    def readline(self, size=-1):
+        line = self._call('readline', size)
+        if not line:
+            self._release()
+        return line
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        try:
+            self.fp.close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        self._release()
+
+
+def _admitted(method, url, headers, data, file, timeout):
+    admission = controller(url)
+    level = current_priority()
+    end = current_deadline()
+    admission.acquire(NORMAL if level is None else level, end)
+    start = time.time()
+    try:
+        timeout = _remaining(timeout)
+    except socket.timeout:
+        # the deadline passed while waiting, the server never saw it
+        admission.release()
+        raise
+    try:
+        f = send(method, url, headers, data, file, timeout)
+    except Exception as e:
+        admission.release(_overloaded(e, end))
+        raise
+    if method == 'GET':
+        latencies.add(endpoint_class(url), time.time() - start)
+    # the request keeps its slot until its body is read
+    result = urllib.addinfourl(_Body(f.fp, admission, end), f.info(), f.geturl(), f.code)
+    result.msg = f.msg
+    if hasattr(f, 'compressed_length'):
+        result.compressed_length = f.compressed_length
+    return result
+
+
+def _hedged(url, headers, timeout):
+    delay = latencies.percentile(endpoint_class(url))
+    if delay is None:
+        return _admitted('GET', url, headers, None, None, timeout)
+
+    answers = Queue.Queue()
+    lock = threading.Lock()
+    state = {'done': False}
+
+    def attempt(n):
+        try:
+            answer = (n, _admitted('GET', url, headers, None, None, timeout), None)
+        except Exception:
+            answer = (n, None, sys.exc_info())
+        with lock:
+            if state['done']:
+                if answer[1] is not None:
+                    answer[1].close()
+                return
+            answers.put(answer)
+
+    def start(n):
+        t = threading.Thread(target=carry(attempt), args=(n,))
+        t.daemon = True
+        t.start()
+
+    def wait(seconds):
+        end = current_deadline()
+        if end is not None:
+            seconds = end - time.time() if seconds is None else min(seconds, end - time.time())
+            if seconds <= 0:
+                raise Queue.Empty
+        return answers.get(timeout=seconds)
+
+    def finish():
+        # close answers which arrived too late
+        with lock:
+            state['done'] = True
+            while not answers.empty():
+                f = answers.get()[1]
+                if f is not None:
+                    f.close()
+
+    try:
+        start(0)
+        try:
+            answer = wait(delay)
+        except Queue.Empty:
+            if current_deadline() is not None and current_deadline() <= time.time():
+                raise
+            start(1)
+            answer = wait(None)
+            if answer[2] is not None:
+                # the other one may still succeed
+                answer = wait(None)
+            latencies.count(answer[0] == 1)
+    except Queue.Empty:
+        raise socket.timeout('deadline exceeded')
+    finally:
+        finish()
+    if answer[2] is not None:
+        (cls, error, tb) = answer[2]
+        raise cls, error, tb
+    return answer[1]
+
+
+def http_request(method, url, headers=None, data=None, file=None, timeout=None):
+    """
+    http_request(method, url, headers=None, data=None, file=None, timeout=None) -> response
+
+    Replacement for osc.core.http_request that waits for admission and
+    applies the deadline, hedging and long polling of the current thread
+    """
+    with tracing.span('%s %s' % (method, url_template(url)), method=method, url=url) as span:
+        _remaining(timeout)
+        try:
+            if getattr(_local, 'longpoll', False):
+                f = send(method, url, headers, data, file, _remaining(timeout))
+            elif method == 'GET' and not data and not file and getattr(_local, 'hedging', False):
+                f = _hedged(url, headers, timeout)
+            else:
+                f = _admitted(method, url, headers, data, file, timeout)
+        except urllib2.HTTPError as e:
+            if span is not None:
+                span.attrs['status'] = e.code
+            raise
+        if span is not None:
+            span.attrs['status'] = f.code
+            if hasattr(f, 'compressed_length'):
+                span.attrs['encoding'] = 'gzip'
+                span.attrs['bytes'] = int(f.compressed_length or -1)
+            else:
+                span.attrs['bytes'] = int(f.info().getheader('content-length') or -1)
+        return f
+
+
+_installed = False
+
+
+def install():
+    """
+    install()
+
+    Route osc.core requests through this module, idempotent
+    """
+    global _installed
+    with _lock:
+        if not _installed:
+            core.http_request = http_request
+            _installed = True
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+# Test of coalesced calls under deadlines.
+#
+# A caller waiting for a call another thread already runs must give up at
+# its own deadline, and must not get the timeout of a first caller that
+# ran out of its deadline while the waiting caller has none.
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import fakeobs
+from buildservice import BuildService, transport
+
+META = '<project name="prj"><title/><description/></project>'
+
+
+def route(method, path, query, body):
+    if path == '/source/prj/_meta':
+        time.sleep(1)
+        return (200, META)
+    return (404, '<status code="404"/>')
+
+
+failures = []
+
+
+def check(what, got, expected):
+    if got != expected:
+        failures.append('%s: got %r, expected %r' % (what, got, expected))
+
+
+def call(bs, results, name, seconds=None):
+    start = time.time()
+    try:
+        if seconds is None:
+            result = bs.getProjectMeta('prj')
+        else:
+            with transport.deadline(seconds):
+                result = bs.getProjectMeta('prj')
+    except Exception as e:
+        result = type(e).__name__
+    results[name] = (result, time.time() - start)
+
+
+def run(bs, first, second):
+    # second starts while the call of first is in flight
+    results = {}
+    threads = [threading.Thread(target=call, args=(bs, results, 'first', first)),
+               threading.Thread(target=call, args=(bs, results, 'second', second))]
+    threads[0].start()
+    time.sleep(0.1)
+    threads[1].start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    (apiurl, log) = fakeobs.serve(route)
+    bs = BuildService(apiurl, fakeobs.oscrc(tmpdir, apiurl))
+
+    results = run(bs, 0.3, None)
+    check('first with deadline', results['first'][0] != META, True)
+    check('second without deadline', results['second'][0], META)
+
+    results = run(bs, None, 0.2)
+    check('first without deadline', results['first'][0], META)
+    check('second with deadline', results['second'][0] != META, True)
+    check('second stopped at its deadline', results['second'][1] < 0.5, True)
+
+    for failure in failures:
+        print failure
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+# Test of exporting project sources again into an existing directory.
+#
+# Identical files of different packages are exported as hard links. When
+# one of them changes on the server, exporting again must replace it
+# without writing into the inode the other package still shares, both when
+# downloading it and when copying it from the cache. Files removed from a
+# package on the server must be removed from the exported package as well.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+import fakeobs
+from buildservice import BuildService
+
+state = {'copying': 'GPL\n' * 1000, 'patch': True}
+
+
+def files():
+    result = {'a': {'a.spec': 'Name: a\n', 'COPYING': state['copying']},
+              'b': {'b.spec': 'Name: b\n', 'COPYING': 'GPL\n' * 1000}}
+    if state['patch']:
+        result['a']['fix.patch'] = '--- a\n+++ b\n'
+    return result
+
+
+def srcmd5(package):
+    return hashlib.md5(repr(sorted(files()[package].items()))).hexdigest()
+
+
+def route(method, path, query, body):
+    parts = path.strip('/').split('/')
+    if path == '/source/prj' and query.get('view') == ['info']:
+        return (200, '<sourceinfolist>%s</sourceinfolist>'
+                     % ''.join('<sourceinfo package="%s" rev="1" srcmd5="%s"/>' % (p, srcmd5(p))
+                               for p in sorted(files())))
+    if len(parts) == 3 and parts[2] in files():
+        entries = ''.join('<entry name="%s" md5="%s" size="%d" mtime="1"/>'
+                          % (name, hashlib.md5(data).hexdigest(), len(data))
+                          for (name, data) in sorted(files()[parts[2]].items()))
+        return (200, '<directory name="%s" srcmd5="%s">%s</directory>'
+                     % (parts[2], srcmd5(parts[2]), entries))
+    if len(parts) == 4 and parts[2] in files() and parts[3] in files()[parts[2]]:
+        return (200, files()[parts[2]][parts[3]])
+    return (404, '<status code="404"/>')
+
+
+failures = []
+
+
+def check(what, got, expected):
+    if got != expected:
+        failures.append('%s: got %r, expected %r' % (what, got, expected))
+
+
+def contents(dest):
+    # first line and size of the COPYING files
+    result = {}
+    for package in ('a', 'b'):
+        data = open(os.path.join(dest, package, 'COPYING')).read()
+        result[package] = (data.split('\n')[0], len(data))
+    return result
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    (apiurl, log) = fakeobs.serve(route)
+    rc = fakeobs.oscrc(tmpdir, apiurl)
+
+    for cached in (False, True):
+        what = cached and 'with cache' or 'without cache'
+        state['copying'] = 'GPL\n' * 1000
+        state['patch'] = True
+        cache_dir = cached and os.path.join(tmpdir, 'cache') or None
+        bs = BuildService(apiurl, rc, cache_dir=cache_dir)
+        dest = tempfile.mkdtemp(dir=tmpdir)
+        bs.exportProjectSources('prj', dest)
+        check('links %s' % what, os.stat(os.path.join(dest, 'b', 'COPYING')).st_nlink, 2)
+
+        state['copying'] = 'MIT\n'
+        state['patch'] = False
+        if cached:
+            # puts the changed file into the cache
+            bs.exportProjectSources('prj', tempfile.mkdtemp(dir=tmpdir))
+        bs.exportProjectSources('prj', dest)
+        check('contents after export %s' % what, contents(dest),
+              {'a': ('MIT', 4), 'b': ('GPL', 4000)})
+        check('leftover files %s' % what,
+              sorted(os.listdir(os.path.join(dest, 'a')) + os.listdir(os.path.join(dest, 'b'))),
+              ['COPYING', 'COPYING', 'a.spec', 'b.spec'])
+
+    for failure in failures:
+        print failure
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+# Local fake API server for the self-contained test scripts.
+#
+# serve(route) starts a server in a background thread which answers every
+# request with route(method, path, query, body), returning (code, body) or
+# (code, body, headers). query is a dict of lists like urlparse.parse_qs
+# returns. All requests are recorded in the returned list as
+# (method, path with query, body) tuples.
+
+import BaseHTTPServer
+import os
+import SocketServer
+import sys
+import threading
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(route):
+    log = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else ''
+            url = urlparse.urlsplit(self.path)
+            query = urlparse.parse_qs(url.query, keep_blank_values=True)
+            log.append((self.command, self.path, body))
+            answer = route(self.command, url.path, query, body)
+            (code, data) = answer[:2]
+            self.send_response(code)
+            for (header, value) in (answer[2] if len(answer) > 2 else {}).items():
+                self.send_header(header, value)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return ('http://127.0.0.1:%d' % server.server_address[1], log)
+
+
+def oscrc(tmpdir, apiurl, user='tester', password='secret'):
+    path = os.path.join(tmpdir, 'oscrc-%s' % user)
+    f = open(path, 'w')
+    f.write('[general]\napiurl = %s\ncookiejar = %s\n' % (apiurl, path + '.cookies'))
+    f.write('[%s]\nuser = %s\npass = %s\nsslcertck = 0\n' % (apiurl, user, password))
+    f.close()
+    os.chmod(path, 0600)
+    return path
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Test of the source cache with a linked package.
+#
+# The fake server has a package 'lnk' linking to a target which changes
+# while the srcmd5 of the link itself stays the same. File lists of the
+# link at its own srcmd5 must follow the target, and cached files must not
+# take more requests than fetching them without a cache.
+
+import hashlib
+import shutil
+import sys
+import tempfile
+
+import fakeobs
+from buildservice import BuildService
+
+LINK = 'a' * 32
+state = {'target': 1}
+
+
+def expansion():
+    # srcmd5 and {name: content} of the expanded link
+    n = state['target']
+    files = {'lnk.spec': 'Name: lnk\n', 'v%d.patch' % n: 'patch %d\n' % n}
+    return (('%d' % n) * 32, files)
+
+
+def directory(srcmd5, files, rev='3'):
+    entries = ''.join('<entry name="%s" md5="%s" size="%d" mtime="1"/>'
+                      % (name, hashlib.md5(data).hexdigest(), len(data))
+                      for (name, data) in sorted(files.items()))
+    return '<directory name="lnk" rev="%s" srcmd5="%s">%s</directory>' % (rev, srcmd5, entries)
+
+
+def route(method, path, query, body):
+    (xsrcmd5, expanded) = expansion()
+    rev = query.get('rev', [None])[0]
+    expand = query.get('expand', ['0'])[0] == '1'
+    link = {'_link': '<link project="target"/>\n'}
+    if rev in (None, 'latest', LINK, '3'):
+        (srcmd5, files) = expand and (xsrcmd5, expanded) or (LINK, link)
+    elif rev == xsrcmd5:
+        (srcmd5, files) = (xsrcmd5, expanded)
+    else:
+        return (404, '<status code="unknown_revision"/>')
+    if path == '/source/prj/lnk':
+        return (200, directory(srcmd5, files))
+    name = path[len('/source/prj/lnk/'):]
+    if name in files:
+        return (200, files[name])
+    return (404, '<status code="404"/>')
+
+
+failures = []
+
+
+def check(what, got, expected):
+    if got != expected:
+        failures.append('%s: got %r, expected %r' % (what, got, expected))
+
+
+def requests(func):
+    # number of requests func() takes
+    n = len(log)
+    func()
+    return len(log) - n
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    (apiurl, log) = fakeobs.serve(route)
+    bs = BuildService(apiurl, fakeobs.oscrc(tmpdir, apiurl), cache_dir=tmpdir + '/cache')
+
+    check('file list of the link', bs.getPackageFileList('prj', 'lnk', LINK),
+          ['lnk.spec', 'v1.patch'])
+    state['target'] = 2
+    check('file list after the target changed', bs.getPackageFileList('prj', 'lnk', LINK),
+          ['lnk.spec', 'v2.patch'])
+
+    xsrcmd5 = expansion()[0]
+    bs.getPackageFileList('prj', 'lnk', xsrcmd5)
+    check('requests for a cached expanded file list',
+          requests(lambda: bs.getPackageFileList('prj', 'lnk', xsrcmd5)), 0)
+
+    check('requests for an uncached file',
+          requests(lambda: bs.getFile('prj', 'lnk', 'lnk.spec')), 2)
+    check('requests for a cached file',
+          requests(lambda: bs.getFile('prj', 'lnk', 'lnk.spec')), 1)
+    check('file content', bs.getFile('prj', 'lnk', 'v2.patch'), 'patch 2\n')
+    check('requests for a file at a revision number',
+          requests(lambda: bs.getFile('prj', 'lnk', 'lnk.spec', revision='3')), 1)
+    check('unexpanded file at a srcmd5', bs.getFile('prj', 'lnk', '_link', LINK, expand=0),
+          '<link project="target"/>\n')
+    check('requests for a cached unexpanded file',
+          requests(lambda: bs.getFile('prj', 'lnk', '_link', LINK, expand=0)), 0)
+    check('requests for a file at a cached expanded srcmd5',
+          requests(lambda: bs.getFile('prj', 'lnk', 'v2.patch', xsrcmd5)), 0)
+
+    for failure in failures:
+        print failure
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
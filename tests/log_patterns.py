@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+# Test of scanBuildLogs with build logs as the server writes them.
+#
+# Every log line starts with the build time, like '[  123s] '. The fake
+# server has failed packages for each anchored and unanchored pattern and
+# one whose log is gone, which must be reported for that package without
+# ending the scan.
+
+import shutil
+import sys
+import tempfile
+
+import fakeobs
+from buildservice import BuildService
+
+LOGS = {
+    'unresolvable': ('[    2s] [1/4] preinstalling\n'
+                     '[    3s] nothing provides libfoo.so.1 needed by bar\n'),
+    'rpmbuild': ('[   12s] + make\n'
+                 '[  123s] error: Bad exit status from /var/tmp/rpm-tmp.x (%build)\n'),
+    'compile': ('[   40s] gcc -c main.c\n'
+                '[   41s] main.c:3:10: fatal error: foo.h: No such file or directory\n'),
+    'clean': '[    1s] all fine\n[    2s] build succeeded\n',
+}
+EXPECTED = {'unresolvable': 'unresolvable', 'rpmbuild': 'rpmbuild',
+            'compile': 'compile', 'clean': None}
+
+
+def route(method, path, query, body):
+    if path == '/build/prj/_result':
+        status = ''.join('<status package="%s" code="failed"/>' % package
+                         for package in sorted(LOGS.keys() + ['gone']))
+        return (200, '<resultlist><result project="prj" repository="repo" arch="i586">'
+                     '%s</result></resultlist>' % status)
+    package = path.split('/')[-2]
+    if path.endswith('/_log') and package in LOGS:
+        start = int(query['start'][0])
+        end = int(query['end'][0])
+        return (200, LOGS[package][start:end])
+    return (404, '<status code="404"/>')
+
+
+failures = []
+
+
+def check(what, got, expected):
+    if got != expected:
+        failures.append('%s: got %r, expected %r' % (what, got, expected))
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    (apiurl, log) = fakeobs.serve(route)
+    bs = BuildService(apiurl, fakeobs.oscrc(tmpdir, apiurl))
+
+    records = dict((r['package'], r) for r in bs.scanBuildLogs('prj', chunk_size=64))
+    check('scanned packages', sorted(records), sorted(LOGS.keys() + ['gone']))
+    for (package, category) in EXPECTED.items():
+        if package in records:
+            check('category of %s' % package, records[package]['category'], category)
+            check('error of %s' % package, records[package]['error'], None)
+    if 'gone' in records:
+        check('error code of gone', getattr(records['gone']['error'], 'code', None), 404)
+        check('hits of gone', records['gone']['hits'], [])
+
+    for failure in failures:
+        print failure
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
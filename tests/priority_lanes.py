@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# Test of the admission priority lanes.
+#
+# With a single request allowed in flight, a response is left unread so
+# that it keeps the slot while a BULK, a NORMAL and an INTERACTIVE request
+# queue up, in that order. Once the response is closed the server has to
+# see them in the order of their lanes.
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import fakeobs
+from buildservice import BuildService, transport
+from osc import core
+
+
+def route(method, path, query, body):
+    return (200, '<directory><entry name="%s"/></directory>' % path)
+
+
+failures = []
+
+
+def check(what, got, expected):
+    if got != expected:
+        failures.append('%s: got %r, expected %r' % (what, got, expected))
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    (apiurl, log) = fakeobs.serve(route)
+    bs = BuildService(apiurl, fakeobs.oscrc(tmpdir, apiurl))
+    transport.configure(apiurl, rate=None, concurrency=1, max_concurrency=1)
+    admission = transport.controller(apiurl)
+
+    with transport.session(bs.session):
+        blocker = core.http_GET(core.makeurl(apiurl, ['source', 'blocker']))
+    check('requests in flight with an unread response', admission.stats()['inflight'], 1)
+
+    threads = []
+    for (name, level) in (('bulk', transport.BULK), ('normal', transport.NORMAL),
+                          ('interactive', transport.INTERACTIVE)):
+        def call(name=name, level=level):
+            with transport.priority(level):
+                bs.getPackageList(name)
+        t = threading.Thread(target=call)
+        t.start()
+        threads.append(t)
+        # wait until the request queues up
+        end = time.time() + 5
+        while admission.stats()['waiting'] < len(threads) and time.time() < end:
+            time.sleep(0.01)
+
+    blocker.close()
+    for t in threads:
+        t.join()
+
+    check('order of the queued requests', [path for (method, path, body) in log[1:]],
+          ['/source/interactive', '/source/normal', '/source/bulk'])
+    check('requests in flight at the end', admission.stats()['inflight'], 0)
+
+    for failure in failures:
+        print failure
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Test of BuildService instances leaving the osc configuration alone.
+#
+# osc.core functions called directly use the configuration loaded into the
+# osc.conf globals, creating instances for other oscrc files must not
+# replace it. Instances whose oscrc doesn't name a cookie jar file must not
+# share the default one, the server sets a cookie per user here.
+
+import os
+import shutil
+import sys
+import tempfile
+
+import fakeobs
+from buildservice import BuildService
+from osc import conf
+
+state = {'user': None}
+
+
+def route(method, path, query, body):
+    return (200, '<directory/>', {'Set-Cookie': 'session=%s; Path=/' % state['user']})
+
+
+def oscrc(tmpdir, apiurl, user):
+    # like fakeobs.oscrc, but with the default cookie jar
+    path = os.path.join(tmpdir, 'oscrc-%s' % user)
+    f = open(path, 'w')
+    f.write('[general]\napiurl = %s\n' % apiurl)
+    f.write('[%s]\nuser = %s\npass = secret\nsslcertck = 0\n' % (apiurl, user))
+    f.close()
+    os.chmod(path, 0600)
+    return path
+
+
+failures = []
+
+
+def check(what, got, expected):
+    if got != expected:
+        failures.append('%s: got %r, expected %r' % (what, got, expected))
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    os.environ['HOME'] = tmpdir
+    (apiurl, log) = fakeobs.serve(route)
+    conf.get_config(override_conffile=oscrc(tmpdir, apiurl, 'main'))
+    (config, cookiejar) = (conf.config, conf.cookiejar)
+
+    jars = {}
+    for user in ('alice', 'bob'):
+        state['user'] = user
+        bs = BuildService(apiurl, oscrc(tmpdir, apiurl, user))
+        check('osc config after %s' % user, conf.config is config, True)
+        check('osc cookie jar after %s' % user, conf.cookiejar is cookiejar, True)
+        bs.getPackageList('prj')
+        jars[user] = bs.session.cookiejar.filename
+        check('user of %s' % user, bs.session.host_options(apiurl)['user'], user)
+
+    check('separate cookie jars', len(set(jars.values() + [cookiejar.filename])), 3)
+    for (user, path) in jars.items():
+        check('cookie of %s' % user, 'session=%s' % user in open(path).read(), True)
+    check('default cookie jar', os.path.exists(cookiejar.filename)
+          and 'session=' in open(cookiejar.filename).read(), False)
+
+    for failure in failures:
+        print failure
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
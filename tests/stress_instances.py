@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+# Stress test for BuildService instances with separate configurations.
+#
+# Starts two local fake API servers which answer with the name of the
+# authenticated user, then hammers three instances (two users on the first
+# server, one on the second, each with its own oscrc) from many threads and
+# checks that every answer was made for the credentials of the instance
+# that asked. Besides plain methods this covers a context manager
+# (editMeta), a generator (scanBuildLogs) and a helper class sending its
+# own requests (RepositoryGraph).
+
+import base64
+import BaseHTTPServer
+import os
+import random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from buildservice import BuildService
+from buildservice.index import RepositoryGraph
+
+THREADS = 24
+CALLS = 50
+
+USERS = {'alice': 'secret-a', 'bob': 'secret-b', 'carol': 'secret-c'}
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def answer(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else ''
+        user = None
+        auth = self.headers.get('Authorization')
+        if auth and auth.startswith('Basic '):
+            (name, password) = base64.b64decode(auth[6:]).split(':', 1)
+            if USERS.get(name) == password:
+                user = name
+        if user is None:
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="fake obs"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        me = '%s@%s' % (user, self.server.name)
+        path = self.path.split('?')[0]
+        if path.startswith('/person/'):
+            if self.command == 'PUT':
+                # the edit must be sent back by the user who read it
+                if '<login>%s.edited</login>' % me not in data:
+                    return self.answer(403, '<status code="wrong user"/>')
+                return self.answer(200, '<status code="ok"/>')
+            return self.answer(200, '<person><login>%s</login></person>' % me)
+        if path.endswith('/_result'):
+            return self.answer(200, '<resultlist><result repository="r" arch="a">'
+                                    '<status package="%s" code="failed"/></result></resultlist>' % me)
+        if path.endswith('/_log'):
+            return self.answer(200, '[    1s] nothing provides %s\n' % me)
+        if path == '/search/project':
+            return self.answer(200, '<collection><project name="%s">'
+                                    '<repository name="r"/></project></collection>' % me)
+        self.answer(200, '<directory><entry name="%s"/></directory>' % me)
+
+    do_GET = do_PUT = handle_request
+
+
+def start_server(name):
+    server = Server(('127.0.0.1', 0), Handler)
+    server.name = name
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def write_oscrc(tmpdir, apiurl, user):
+    path = os.path.join(tmpdir, 'oscrc-%s' % user)
+    f = open(path, 'w')
+    f.write('[general]\napiurl = %s\ncookiejar = %s\n' % (apiurl, path + '.cookies'))
+    f.write('[%s]\nuser = %s\npass = %s\nsslcertck = 0\n' % (apiurl, user, USERS[user]))
+    f.close()
+    os.chmod(path, 0600)
+    return path
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    server1 = start_server('one')
+    server2 = start_server('two')
+    instances = [(BuildService(server1, write_oscrc(tmpdir, server1, 'alice')), 'alice@one'),
+                 (BuildService(server2, write_oscrc(tmpdir, server2, 'bob')), 'bob@two'),
+                 (BuildService(server1, write_oscrc(tmpdir, server1, 'carol')), 'carol@one')]
+
+    errors = []
+
+    def package_list(bs):
+        return bs.getPackageList('Test:%d' % random.randint(0, 3))
+
+    def edit_meta(bs):
+        with bs.editMeta('user', 'someone') as person:
+            login = person.find('login')
+            login.text += '.edited'
+        return [login.text[:-len('.edited')]]
+
+    def scan_logs(bs):
+        records = list(bs.scanBuildLogs('Test', workers=2))
+        return [r['hits'][0][2].split()[-1] if r['hits'] else repr(r['error'])
+                for r in records]
+
+    def repository_graph(bs):
+        graph = RepositoryGraph(bs)
+        graph.load()
+        return [repo.split('/')[0] for repo in graph.repositories()]
+
+    calls = [package_list, edit_meta, scan_logs, repository_graph]
+
+    def worker():
+        for i in range(CALLS):
+            (bs, expected) = random.choice(instances)
+            call = random.choice(calls)
+            try:
+                got = call(bs)
+            except Exception as e:
+                errors.append('%s %s: %r' % (call.__name__, expected, e))
+                continue
+            if got != [expected]:
+                errors.append('%s %s got %s' % (call.__name__, expected, got))
+
+    print "Running %d threads doing %d calls each on %d instances" % (THREADS, CALLS, len(instances))
+    threads = [threading.Thread(target=worker) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for error in errors[:20]:
+        print error
+    if errors:
+        print "FAILED: %d of %d calls" % (len(errors), THREADS * CALLS)
+        sys.exit(1)
+    print "OK"
+finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)